@@ -4,7 +4,7 @@
 Lab 06 - API Flask
 Requiere Python 3.10 o superior
 """
-from flask import Flask, render_template, request, send_from_directory, redirect, url_for, jsonify
+from flask import Flask, render_template, request, send_from_directory, send_file, redirect, url_for, jsonify, Response, stream_with_context
 import os
 import re
 import requests
@@ -16,10 +16,38 @@ import traceback
 import warnings
 import logging
 import subprocess
+import shutil
+import errno
+import json
+import sys
+import hashlib
+import mimetypes
+import sqlite3
+import click
+from pathlib import Path
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode, quote
+import signal
+import socket
+from collections import deque, Counter, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+from contextlib import contextmanager
+from enum import Enum
+from functools import wraps, lru_cache
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 from yt_dlp import YoutubeDL
 from difflib import get_close_matches
 
+try:
+    import fcntl  # Locks de archivo para reclamar tareas del diario (no existe en Windows)
+except ImportError:
+    fcntl = None
+
+try:
+    from yt_dlp.utils import Popen as YtDlpPopen  # Clase interna de yt-dlp (ver track_ytdlp_processes)
+except ImportError:
+    YtDlpPopen = None
+
 # Suprimir advertencias de deprecación de Python y yt-dlp
 warnings.filterwarnings('ignore', category=DeprecationWarning)
 warnings.filterwarnings('ignore', message='.*Support for Python version.*')
@@ -74,17 +102,336 @@ if not verify_yt_dlp():
     print("Warning: yt-dlp verification failed, but continuing anyway...")
 
 app = Flask(__name__)
-DOWNLOAD_DIR = os.path.join(os.path.dirname(__file__), "downloads")
+DOWNLOAD_DIR = os.environ.get("DOWNLOAD_DIR") or os.path.join(os.path.dirname(__file__), "downloads")
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
+# URL base de PokeAPI (configurable para usar un servidor local en benchmarks)
+POKEAPI_BASE_URL = os.environ.get("POKEAPI_BASE_URL", "https://pokeapi.co/api/v2").rstrip("/")
+
 # Configuración de límites
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024  # 2GB máximo por archivo
 MAX_FILE_AGE_DAYS = 7  # Días antes de eliminar archivos antiguos
 
+# Espacio en disco: los intermedios van a un directorio de trabajo por tarea (puede ser tmpfs)
+# y el archivo final se mueve a DOWNLOAD_DIR con un rename atómico
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR") or os.path.join(DOWNLOAD_DIR, ".scratch")
+os.makedirs(SCRATCH_DIR, exist_ok=True)
+SCRATCH_SAME_VOLUME = os.stat(SCRATCH_DIR).st_dev == os.stat(DOWNLOAD_DIR).st_dev
+DISK_MIN_FREE = int(float(os.environ.get("DISK_MIN_FREE_MB", "1024")) * 1024 * 1024)  # Marca de agua
+# Marca de agua propia si el directorio de trabajo está en otro volumen (un tmpfs suele ser pequeño)
+SCRATCH_MIN_FREE = int(float(os.environ.get("SCRATCH_MIN_FREE_MB", "256")) * 1024 * 1024)
+DISK_RESERVE_FACTOR = 2.0  # Pico de intermedios: formatos sueltos + combinado/recortado
+disk_reservations = {}  # task_id -> {directorio: bytes reservados}
+
 # Almacenamiento de progreso de descargas
-download_progress = {}
+download_progress = {}  # task_id -> TaskState
 download_results = {}
 
+# Diario de tareas: las descargas en curso sobreviven a un reinicio del proceso
+TASK_JOURNAL_DIR = os.path.join(DOWNLOAD_DIR, ".journal")  # Oculto para los listados
+TASK_MAX_RESUMES = 3  # Reanudaciones máximas de una tarea (evita bucles si la tarea tumba el proceso)
+# Archivos intermedios de yt-dlp: .part, .ytdl, fragmentos y formatos sueltos antes de combinar
+PARTIAL_FILE_RE = re.compile(r"\.(part|ytdl)$|\.part-Frag\d+$|\.f\d+\.\w+$|\.temp\.\w+$")
+PUBLISH_TEMP_RE = re.compile(r"^\..+\.[0-9a-f]{32}\.tmp$")  # Copia a medio publicar (ver publish_download)
+# Errores de os.link en volúmenes sin enlaces duros (SMB, FAT, algunos volúmenes de contenedores)
+LINK_UNSUPPORTED_ERRNOS = {errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS, errno.EMLINK}
+PARTIAL_GRACE_SECONDS = 3600  # Un parcial sin tarea y sin modificar durante este tiempo se elimina
+os.makedirs(TASK_JOURNAL_DIR, exist_ok=True)
+journal_handles = {}  # task_id -> (archivo del diario bloqueado por este proceso, entrada)
+journal_lock = threading.Lock()
+_journal_resumed = False
+
+# Cancelación: DELETE /api/download/<task_id> o clientes que dejaron de consultar el progreso
+# Segundos sin consultas de progreso tras los que se cancela una tarea. Desactivado por defecto:
+# un cliente de la API puede consultar mucho después; la página cancela al cerrarse (DELETE keepalive)
+TASK_IDLE_TIMEOUT = float(os.environ.get("TASK_IDLE_TIMEOUT", "0"))
+REAPER_INTERVAL = 5  # Cada cuántos segundos se buscan tareas abandonadas
+CANCEL_MESSAGES = {
+    "user": "Descarga cancelada",
+    "idle": "Descarga cancelada: el cliente dejó de consultar el progreso",
+    "reclaimed": "La descarga se reasignó a otro nodo",
+}
+task_processes = {}  # task_id -> proceso en curso (ffmpeg propio o de yt-dlp) para matarlo al cancelar
+_task_thread = threading.local()  # task_id de la descarga que corre en este hilo
+_reaper_started = False
+reaper_lock = threading.Lock()
+
+# Planificación de descargas: trabajo corto primero con reparto justo entre clientes
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))  # Descargas simultáneas
+SMALL_JOB_BYTES = 50 * 1024 * 1024  # Hasta este tamaño estimado una tarea es "pequeña"
+DEFAULT_TASK_COST = 100 * 1024 * 1024  # Costo supuesto cuando no hay ningún dato del video
+AGING_HALF_LIFE = 60.0  # Cada minuto de espera el costo efectivo de una tarea se reduce a la mitad
+# Pesos por API key (X-API-Key), ej. "equipo-a=2,equipo-b=0.5"; las keys no listadas se tratan por IP
+CLIENT_WEIGHTS = {
+    key.strip(): float(weight)
+    for key, _, weight in (item.partition("=") for item in os.environ.get("CLIENT_WEIGHTS", "").split(","))
+    if key.strip() and weight
+}
+# Bytes por segundo aproximados por calidad, para estimar el costo con solo la duración
+QUALITY_BYTES_PER_SECOND = {
+    "audio": 24_000,
+    144: 15_000,
+    240: 30_000,
+    360: 60_000,
+    480: 120_000,
+    720: 250_000,
+    1080: 500_000,
+    1440: 1_200_000,
+    2160: 2_500_000,
+}
+FORMAT_ESTIMATES_SIZE = 1024  # URLs cuyos tamaños por calidad se recuerdan (de /api/formats/list)
+format_estimates = OrderedDict()  # URL canónica -> {"duration": s, "sizes": {calidad: bytes}}
+format_estimates_lock = threading.Lock()
+
+# Sondeo anticipado de formatos: /api/detect-platform lanza el extract_info en segundo plano y
+# /api/formats/list usa ese resultado (o espera al sondeo en curso en vez de repetirlo)
+FORMATS_PROBE_TTL = 120  # Segundos que un sondeo terminado sirve para /api/formats/list
+FORMATS_PROBE_CACHE_SIZE = 256
+FORMATS_PROBE_WORKERS = int(os.environ.get("FORMATS_PROBE_WORKERS", "4"))  # Sondeos anticipados simultáneos
+SESSION_PROBES_SIZE = 1024
+formats_probe_pool = ThreadPoolExecutor(max_workers=FORMATS_PROBE_WORKERS, thread_name_prefix="formats-probe")
+formats_probe_slots = threading.BoundedSemaphore(FORMATS_PROBE_WORKERS)  # Sondeos anticipados sin terminar
+formats_probes = OrderedDict()  # URL canónica -> FormatsProbe
+session_probes = OrderedDict()  # sesión -> URL canónica de su último sondeo anticipado
+formats_probes_lock = threading.Lock()
+
+# Modo distribuido: varios nodos comparten una cola de tareas en SQLite (en almacenamiento compartido).
+# Cada nodo toma tareas cuando tiene workers libres, publica su progreso y registra sus archivos
+CLUSTER_DB = os.environ.get("CLUSTER_DB")  # Sin definir: modo de un solo nodo
+NODE_ID = os.environ.get("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"  # Único por proceso
+NODE_URL = (os.environ.get("NODE_URL") or "").rstrip("/")  # URL con la que los demás nodos llegan a este
+CLUSTER_POLL_INTERVAL = 1.0  # Segundos entre sincronizaciones (latido, progreso, tareas nuevas)
+NODE_DEAD_AFTER = float(os.environ.get("NODE_DEAD_AFTER", "30"))  # Sin latido: sus tareas vuelven a la cola
+CLUSTER_CLAIM_SCAN = 200  # Tareas en cola que se evalúan en cada toma
+cluster_tasks = set()  # task_id de las tareas que este nodo tomó y todavía no publicó como terminadas
+cluster_pushed = {}  # task_id -> último progreso publicado (solo se escribe si cambia)
+cluster_wakeup = threading.Event()
+_cluster_local = threading.local()  # Una conexión por hilo
+_cluster_started = False
+cluster_start_lock = threading.Lock()
+
+class TaskStatus(str, Enum):
+    """Estados posibles de una descarga (valores únicos compartidos por todas las tareas)"""
+    QUEUED = "queued"
+    STARTING = "starting"
+    DOWNLOADING = "downloading"
+    PROCESSING = "processing"
+    COMPLETED = "completed"
+    ERROR = "error"
+    CANCELLED = "cancelled"
+
+STATUS_MESSAGES = {
+    TaskStatus.QUEUED: "En cola, esperando turno de descarga...",
+    TaskStatus.STARTING: "Iniciando descarga...",
+    TaskStatus.DOWNLOADING: "Descargando...",
+    TaskStatus.PROCESSING: "Procesando archivo...",
+    TaskStatus.COMPLETED: "Descarga completada",
+    TaskStatus.ERROR: "Error en la descarga",
+    TaskStatus.CANCELLED: "Descarga cancelada",
+}
+FINAL_STATUSES = (TaskStatus.COMPLETED, TaskStatus.ERROR, TaskStatus.CANCELLED)
+PROGRESS_MIN_STEP = 1.0  # Puntos porcentuales mínimos para actualizar el progreso
+PROGRESS_MIN_BYTES = 1024 * 1024  # Sin tamaño total (HLS, en vivo) se actualiza cada MB descargado
+DISK_CHECK_INTERVAL = 1.0  # Segundos entre revisiones del espacio libre durante una descarga
+
+class TaskState:
+    """Estado compacto y mutable de una descarga.
+
+    Se actualiza en el lugar desde progress_hook (sin crear diccionarios por evento)
+    y el mensaje solo se construye al serializar con to_dict()."""
+    __slots__ = ("status", "percent", "downloaded_bytes", "total_bytes", "speed", "note", "last_seen", "cancel_reason")
+
+    def __init__(self, status: TaskStatus = TaskStatus.STARTING, percent: float = 0, note: str = None):
+        self.status = status
+        self.percent = percent
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.speed = None
+        self.note = note  # Mensaje explícito; si es None se usa el mensaje del estado
+        self.last_seen = time.monotonic()  # Última consulta de progreso de un cliente
+        self.cancel_reason = None  # "user" o "idle" cuando se pidió cancelar
+
+    def update(self, status: TaskStatus, percent: float, note: str = None):
+        self.status = status
+        self.percent = percent
+        self.note = note
+
+    @property
+    def message(self) -> str:
+        if self.note is not None:
+            return self.note
+        if self.status is TaskStatus.DOWNLOADING:
+            return f"Descargando... {self.percent:.1f}%"
+        return STATUS_MESSAGES[self.status]
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status.value,
+            "percent": self.percent,
+            "message": self.message,
+            "downloaded_bytes": self.downloaded_bytes,
+            "total_bytes": self.total_bytes,
+            "speed": self.speed,
+        }
+
+class FormatsProbe:
+    """Sondeo de formatos de una URL, en curso o terminado"""
+    __slots__ = ("future", "created", "sessions", "speculative")
+
+    def __init__(self, future: Future, speculative: bool):
+        self.future = future
+        self.created = time.monotonic()
+        self.sessions = set()  # Sesiones cuyo último sondeo anticipado es este
+        self.speculative = speculative  # Nadie espera el resultado todavía: se puede cancelar
+
+    def usable(self, now: float) -> bool:
+        if self.future.cancelled():
+            return False
+        if not self.future.done():
+            return True  # En curso: se espera en vez de sondear de nuevo
+        # Terminado: solo se reutiliza un resultado correcto y reciente
+        return self.future.exception() is None and self.future.result()[1] == 200 and now - self.created < FORMATS_PROBE_TTL
+
+class TaskCancelled(Exception):
+    """Se lanza dentro de la tarea (p. ej. desde progress_hook) para detenerla"""
+
+def check_cancelled(state: TaskState):
+    if state.cancel_reason:
+        raise TaskCancelled(state.cancel_reason)
+
+# Consultas a PokeAPI: sesión compartida y pool acotado para consultas en lote
+POKEAPI_WORKERS = int(os.environ.get("POKEAPI_WORKERS", "8"))
+POKEMON_BATCH_LIMIT = 1000  # Nombres máximos por consulta en lote
+POKEMON_STREAM_THRESHOLD = 50  # A partir de este tamaño se responde en NDJSON
+SPRITE_KEYS = ("front_default", "front_shiny", "back_default", "back_shiny")
+pokeapi_session = requests.Session()
+pokeapi_session.mount("http://", HTTPAdapter(pool_maxsize=POKEAPI_WORKERS))
+pokeapi_session.mount("https://", HTTPAdapter(pool_maxsize=POKEAPI_WORKERS))
+pokeapi_pool = ThreadPoolExecutor(max_workers=POKEAPI_WORKERS, thread_name_prefix="pokeapi")
+
+# Proyecciones ya parseadas (los datos de PokeAPI casi no cambian)
+POKEMON_CACHE_SIZE = int(os.environ.get("POKEMON_CACHE_SIZE", "512"))
+POKEMON_CACHE_TTL = 24 * 60 * 60  # Segundos
+pokemon_cache = OrderedDict()  # nombre -> (expira, proyección)
+pokemon_cache_lock = threading.Lock()
+MOVES_PAGE_SIZE = 40  # Movimientos por página en /pokemon y /api/pokemon/<name>/moves
+
+# Parseo parcial: claves que se localizan en el texto sin construir el árbol completo
+_json_decoder = json.JSONDecoder()
+MOVE_KEY_RE = re.compile(r'"move"\s*:\s*(?=\{)')
+TYPES_KEY_RE = re.compile(r'"types"\s*:\s*(?=\[)')
+SPRITES_KEY_RE = re.compile(r'"sprites"\s*:\s*(?=\{)')
+ID_KEY_RE = re.compile(r'"id"\s*:\s*(\d+)')
+
+# Modo offline: PokeAPI se lee desde un snapshot SQLite local (ver comando pokeapi-snapshot)
+POKEAPI_OFFLINE = os.environ.get("POKEAPI_OFFLINE") == "1"
+POKEAPI_SNAPSHOT = os.environ.get("POKEAPI_SNAPSHOT") or os.path.join(os.path.dirname(__file__), "cache", "pokeapi.sqlite3")
+SNAPSHOT_MMAP_SIZE = 256 * 1024 * 1024  # SQLite lee el archivo mapeado en memoria
+_snapshot_local = threading.local()  # Una conexión de solo lectura por hilo
+_snapshot_names = {"mtime": None, "names": []}
+
+# Caché local de sprites de Pokémon (se descargan una vez y se sirven desde disco)
+SPRITE_CACHE_DIR = os.environ.get("SPRITE_CACHE_DIR") or os.path.join(os.path.dirname(__file__), "cache", "sprites")
+SPRITE_ALLOWED_HOSTS = {"raw.githubusercontent.com"}  # Solo se hace proxy de estos hosts
+SPRITE_MAX_AGE = 365 * 24 * 60 * 60  # Un año: el contenido de una URL de sprite no cambia
+os.makedirs(SPRITE_CACHE_DIR, exist_ok=True)
+sprite_sources = {}  # clave (hash de la URL) -> URL remota
+sprite_locks = {}
+sprite_locks_guard = threading.Lock()
+
+# Vistas previas de descargas: miniaturas reducidas y tiras de fotogramas clave para el recorte.
+# El nombre de cada archivo es un hash de su origen (URL, o archivo + tamaño + fecha), así que
+# su contenido nunca cambia y se sirve con caché inmutable
+PREVIEW_CACHE_DIR = os.environ.get("PREVIEW_CACHE_DIR") or os.path.join(os.path.dirname(__file__), "cache", "previews")
+PREVIEW_MAX_AGE = 365 * 24 * 60 * 60
+THUMBNAIL_WIDTH = 480  # Ancho máximo de la miniatura reducida
+THUMBNAIL_MAX_BYTES = 5 * 1024 * 1024  # Miniaturas remotas más grandes se rechazan
+STRIP_FRAMES = 12  # Fotogramas por tira por defecto
+STRIP_MAX_FRAMES = 40
+STRIP_FRAME_WIDTH = 160
+FFMPEG_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+os.makedirs(PREVIEW_CACHE_DIR, exist_ok=True)
+thumbnail_sources = {}  # clave -> URL remota de la miniatura (también en <clave>.url, ver remember_source)
+preview_locks = {}
+preview_locks_guard = threading.Lock()
+# Última descarga completa (sin recortar) de cada URL: su tira se ofrece al elegir el recorte
+COMPLETED_DOWNLOADS_SIZE = 1024
+completed_downloads = OrderedDict()  # URL canónica -> nombre del archivo de video
+completed_downloads_lock = threading.Lock()  # Lo modifican los hilos de descarga
+
+# Clasificación de URLs: host -> plataforma (se compara por sufijo de dominio completo)
+PLATFORMS = {
+    "youtube": {"name": "YouTube", "icon": "▶", "color": "#FF0000"},
+    "tiktok": {"name": "TikTok", "icon": "🎵", "color": "#000000"},
+    "instagram": {"name": "Instagram", "icon": "📷", "color": "#E4405F"},
+    "facebook": {"name": "Facebook", "icon": "👥", "color": "#1877F2"},
+    "twitter": {"name": "Twitter/X", "icon": "🐦", "color": "#1DA1F2"},
+}
+GENERIC_PLATFORM = {"name": "Video", "icon": "🎬", "color": "#666666"}
+PLATFORM_HOSTS = {
+    "youtube.com": "youtube",
+    "youtu.be": "youtube",
+    "youtube-nocookie.com": "youtube",
+    "tiktok.com": "tiktok",
+    "instagram.com": "instagram",
+    "instagr.am": "instagram",
+    "facebook.com": "facebook",
+    "fb.com": "facebook",
+    "fb.watch": "facebook",
+    "twitter.com": "twitter",
+    "x.com": "twitter",
+}
+YOUTUBE_ID_RE = re.compile(r"[0-9A-Za-z_-]{11}")
+YOUTUBE_PATH_PREFIXES = ("embed", "shorts", "live", "v", "e")  # /<prefijo>/<id>
+TIKTOK_VIDEO_RE = re.compile(r"/(@[\w.-]+)/(video|photo)/(\d+)")
+INSTAGRAM_MEDIA_RE = re.compile(r"(?:/[\w.]+)?/(p|reel|reels|tv)/([\w-]+)")
+TWITTER_STATUS_RE = re.compile(r"/(\w+)/status(?:es)?/(\d+)")
+# Parámetros de seguimiento que no cambian el contenido y romperían la deduplicación
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "igsh", "igshid", "mibextid"}
+FACEBOOK_VIDEO_PARAMS = ("v", "story_fbid", "id")  # Lo único que identifica el video en el query
+URL_CACHE_SIZE = 4096  # URLs clasificadas que se recuerdan
+# URL canónica de un video completo por plataforma: solo esas se sondean por anticipado
+PREFETCH_MEDIA_RE = {
+    "youtube": re.compile(r"https://www\.youtube\.com/watch\?v=[0-9A-Za-z_-]{11}"),
+    "tiktok": re.compile(r"https://www\.tiktok\.com/@[\w.-]+/(video|photo)/\d+|https://(vm|vt)\.tiktok\.com/\w+/?"),
+    "instagram": re.compile(r"https://www\.instagram\.com/(p|reel|tv)/[\w-]+/"),
+    "twitter": re.compile(r"https://x\.com/\w+/status/\d+"),
+    "facebook": re.compile(r"https://([\w-]+\.)?(facebook|fb)\.com/([^?]+/videos/[\w.-]+/?|reel/\d+/?|[^?]*\?(v|story_fbid|id)=\d+.*)|https://fb\.watch/[\w-]+/?"),
+}
+ClassifiedURL = namedtuple("ClassifiedURL", ["platform", "canonical"])
+
+# Audio: contenedores a los que se puede copiar el stream sin recodificar
+AUDIO_CONTAINERS = ["m4a", "opus", "mp3"]  # Orden de preferencia para "audio_original"
+AUDIO_CODEC_CONTAINERS = {"mp4a": "m4a", "aac": "m4a", "opus": "opus", "mp3": "mp3"}
+AUDIO_TRANSCODE_ARGS = {
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "192k"],
+    "m4a": ["-c:a", "aac", "-b:a", "192k"],
+    "opus": ["-c:a", "libopus", "-b:a", "128k"],
+}
+# Las recodificaciones usan CPU: como máximo una por núcleo al mismo tiempo
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS") or os.cpu_count() or 2)
+TRANSCODE_TIMEOUT = 1800  # Segundos
+transcode_slots = threading.BoundedSemaphore(TRANSCODE_WORKERS)
+
+# Trazas por etapa de las descargas (en memoria con forma de span; el archivo se exporta en OTLP/JSON)
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "5000"))  # Spans en memoria
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE")  # Archivo JSONL opcional
+TRACE_SERVICE_NAME = "lab06"
+OTLP_STATUS_CODES = {"OK": 1, "ERROR": 2}
+trace_spans = deque(maxlen=TRACE_BUFFER_SIZE)
+trace_lock = threading.Lock()
+_trace_context = threading.local()
+
+# Perfilado bajo demanda (desactivado por defecto)
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED") == "1"
+PROFILE_HEADER = "X-Profile"  # Header que activa el perfilado de un request
+PROFILE_MAX_SECONDS = 60  # Duración máxima de un perfil de proceso
+PROFILE_REQUEST_INTERVAL = 0.001  # Intervalo de muestreo de un request (segundos)
+PROFILE_SIGNAL_SECONDS = float(os.environ.get("PROFILE_SIGNAL_SECONDS", "30"))
+PROFILE_OUTPUT_DIR = os.environ.get("PROFILE_OUTPUT_DIR") or os.path.join(os.path.dirname(__file__), "profiles")
+request_profiles = {}  # profile_id -> perfil de un request
+request_profile_ids = deque(maxlen=50)  # Solo se guardan los últimos perfiles
+
 def safe_filename(name: str, max_length: int = 100) -> str:
     """Crea un nombre de archivo seguro limitando su longitud"""
     name = re.sub(r"[\\/*?\"<>|:]", "_", name)
@@ -94,43 +441,393 @@ def safe_filename(name: str, max_length: int = 100) -> str:
         name = name[:max_length].rstrip("_")
     return name or f"video_{int(datetime.now().timestamp())}"
 
-def clean_youtube_url(url: str) -> str:
-    """Limpia y convierte la URL de YouTube eliminando parámetros innecesarios que pueden causar problemas"""
+def platform_for_host(host: str):
+    """Devuelve la plataforma del host o de su dominio padre más cercano.
+    Solo compara etiquetas completas: "box.com" no coincide con "x.com"."""
+    labels = host.split(".")
+    for i in range(len(labels) - 1):
+        platform = PLATFORM_HOSTS.get(".".join(labels[i:]))
+        if platform:
+            return platform
+    return None
+
+def strip_tracking(query: str) -> str:
+    """Quita los parámetros de seguimiento (utm_*, fbclid, ...) de un query string"""
+    params = [
+        (k, v) for k, v in parse_qsl(query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith("utm_")
+    ]
+    return urlencode(params)
+
+def canonical_youtube(parsed, host: str):
+    """https://www.youtube.com/watch?v=<id> para watch, youtu.be, embed, shorts y live"""
+    parts = [p for p in parsed.path.split("/") if p]
+    if host.endswith("youtu.be"):
+        video_id = parts[0] if parts else None
+    elif parts and parts[0] == "watch":
+        video_id = dict(parse_qsl(parsed.query)).get("v")
+    elif len(parts) >= 2 and parts[0] in YOUTUBE_PATH_PREFIXES:
+        video_id = parts[1]
+    else:
+        video_id = None
+    if video_id and YOUTUBE_ID_RE.fullmatch(video_id):
+        return f"https://www.youtube.com/watch?v={video_id}"
+    return None
+
+def canonical_tiktok(parsed, host: str):
+    """https://www.tiktok.com/@usuario/video/<id>; los enlaces cortos (vm.) solo pierden el query"""
+    match = TIKTOK_VIDEO_RE.match(parsed.path)
+    if match:
+        return f"https://www.tiktok.com/{match.group(1)}/{match.group(2)}/{match.group(3)}"
+    return urlunparse(("https", host, parsed.path, "", "", ""))
+
+def canonical_instagram(parsed, host: str):
+    """https://www.instagram.com/<p|reel|tv>/<código>/ sin igsh ni usuario en la ruta"""
+    match = INSTAGRAM_MEDIA_RE.match(parsed.path)
+    if match:
+        kind = "reel" if match.group(1) == "reels" else match.group(1)
+        return f"https://www.instagram.com/{kind}/{match.group(2)}/"
+    return None
+
+def canonical_twitter(parsed, host: str):
+    """https://x.com/<usuario>/status/<id> para twitter.com, x.com y sus subdominios"""
+    match = TWITTER_STATUS_RE.match(parsed.path)
+    if match:
+        return f"https://x.com/{match.group(1)}/status/{match.group(2)}"
+    return None
+
+def canonical_facebook(parsed, host: str):
+    """Conserva la ruta y solo los parámetros que identifican el video (mibextid, rdid... se descartan)"""
+    query = urlencode([(k, v) for k, v in parse_qsl(parsed.query) if k in FACEBOOK_VIDEO_PARAMS])
+    host = "www.facebook.com" if host == "facebook.com" else host
+    return urlunparse(("https", host, parsed.path, "", query, ""))
+
+CANONICALIZERS = {
+    "youtube": canonical_youtube,
+    "tiktok": canonical_tiktok,
+    "instagram": canonical_instagram,
+    "twitter": canonical_twitter,
+    "facebook": canonical_facebook,
+}
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def classify_url(url: str) -> ClassifiedURL:
+    """Clasifica la URL y devuelve (plataforma, URL canónica) parseando el host una sola vez.
+    La URL canónica es la que se usa para descargar y como clave de caché/deduplicación;
+    si no se reconoce el formato se devuelve la URL original sin parámetros de seguimiento."""
+    url = (url or "").strip()
     if not url:
-        return url
+        return ClassifiedURL(None, url)
+    try:
+        parsed = urlparse(url if "://" in url else f"//{url}")
+    except ValueError:
+        return ClassifiedURL(None, url)  # Mal formada (p. ej. "http://[abc/video")
+    host = (parsed.hostname or "").rstrip(".")
+    if not host:
+        return ClassifiedURL(None, url)
+    if host.startswith("www."):
+        host = host[4:]
+
+    platform = platform_for_host(host)
+    canonical = CANONICALIZERS[platform](parsed, host) if platform else None
+    if canonical is None:
+        query = strip_tracking(parsed.query)
+        canonical = url if query == parsed.query else urlunparse(parsed._replace(query=query, fragment=""))
+    return ClassifiedURL(platform, canonical)
+
+def canonical_url(url: str) -> str:
+    """URL canónica para descargar (ver classify_url)"""
+    return classify_url(url).canonical
+
+def parse_audio_quality(quality: str):
+    """Devuelve los contenedores aceptados para una calidad de audio, o None si no es audio.
+    "audio" mantiene el comportamiento original (MP3); "audio_original" acepta cualquier
+    contenedor que no requiera recodificar."""
+    if quality == "audio":
+        return ["mp3"]
+    if quality.startswith("audio_"):
+        target = quality[len("audio_"):]
+        if target == "original":
+            return list(AUDIO_CONTAINERS)
+        if target in AUDIO_CONTAINERS:
+            return [target]
+    return None
+
+def choose_audio_format(formats: list, accepted: list):
+    """Busca un formato solo-audio cuyo códec ya corresponde a un contenedor aceptado.
+    Devuelve (format_id, contenedor) o None si hay que recodificar."""
+    candidates = {}
+    for fmt in formats or []:
+        acodec = fmt.get('acodec') or 'none'
+        if fmt.get('vcodec') != 'none' or acodec == 'none' or not fmt.get('format_id'):
+            continue
+        container = AUDIO_CODEC_CONTAINERS.get(acodec.split('.')[0].lower())
+        if container:
+            candidates.setdefault(container, []).append(fmt)
     
-    url_lower = url.lower()
+    for container in accepted:
+        if container in candidates:
+            best = max(candidates[container], key=lambda f: f.get('abr') or f.get('tbr') or 0)
+            return best['format_id'], container
+    return None
+
+def run_task_process(task_id: str, cmd: list, timeout: float) -> subprocess.CompletedProcess:
+    """Como subprocess.run, pero registra el proceso para que cancel_task pueda matarlo"""
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    task_processes[task_id] = process
+    try:
+        state = download_progress.get(task_id)
+        if state is not None and state.cancel_reason:
+            process.kill()  # Se canceló justo antes de registrar el proceso
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    finally:
+        task_processes.pop(task_id, None)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def track_ytdlp_processes(init):
+    """Envuelve Popen.__init__ de yt-dlp para registrar en task_processes los procesos
+    que lanzan sus postprocesadores (merge, ExtractAudio) desde el hilo de una tarea"""
+    @wraps(init)
+    def wrapper(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        task_id = getattr(_task_thread, "task_id", None)
+        if task_id is None:
+            return
+        task_processes[task_id] = self
+        state = download_progress.get(task_id)
+        if state is not None and state.cancel_reason:
+            self.kill()  # Se canceló justo antes de registrar el proceso
+    return wrapper
+
+# yt-dlp no expone los procesos de sus postprocesadores: sin este registro, cancelar una tarea
+# durante un merge o ExtractAudio esperaría a que ffmpeg termine. Si una versión de yt-dlp cambia
+# esa clase, la cancelación solo ocurre en los puntos de control (progress/postprocessor hooks)
+if isinstance(YtDlpPopen, type) and issubclass(YtDlpPopen, subprocess.Popen):
+    YtDlpPopen.__init__ = track_ytdlp_processes(YtDlpPopen.__init__)
+else:
+    print("Warning: yt-dlp sin utils.Popen: la cancelación no podrá detener su ffmpeg en curso")
+
+def transcode_audio(src_path: str, container: str, start_time: float = None, end_time: float = None, task_id: str = None) -> str:
+    """Recodifica un archivo de audio con ffmpeg (y recorta si se indica). Devuelve la ruta final."""
+    base_name, ext = os.path.splitext(src_path)
+    dst_path = f"{base_name}.{container}"
+    out_path = f"{base_name}_transcoded.{container}" if dst_path == src_path else dst_path
     
-    # Detectar y convertir diferentes formatos de URLs de YouTube
-    if "youtube.com" in url_lower or "youtu.be" in url_lower:
-        # Extraer video ID de diferentes formatos:
-        # - https://www.youtube.com/watch?v=VIDEO_ID
-        # - https://youtu.be/VIDEO_ID
-        # - https://www.youtube.com/embed/VIDEO_ID
-        # - https://m.youtube.com/watch?v=VIDEO_ID
-        # - URLs con parámetros adicionales
-        
-        video_id_match = re.search(r'(?:v=|/)([0-9A-Za-z_-]{11})', url)
-        if video_id_match:
-            video_id = video_id_match.group(1)
-            # Construir URL limpia y estándar
-            return f"https://www.youtube.com/watch?v={video_id}"
-        else:
-            # Si no se encuentra el ID, intentar extraer de otros formatos
-            # Formato youtu.be
-            youtu_be_match = re.search(r'youtu\.be/([0-9A-Za-z_-]{11})', url)
-            if youtu_be_match:
-                video_id = youtu_be_match.group(1)
-                return f"https://www.youtube.com/watch?v={video_id}"
+    ffmpeg_cmd = ['ffmpeg']
+    if start_time is not None and end_time is not None and start_time < end_time:
+        ffmpeg_cmd += ['-ss', str(start_time), '-t', str(end_time - start_time)]
+    ffmpeg_cmd += ['-i', src_path, '-vn', *AUDIO_TRANSCODE_ARGS[container], '-y', out_path]
     
-    # Para otras plataformas, limpiar parámetros innecesarios comunes
-    # TikTok, Instagram, etc. pueden tener parámetros que causan problemas
-    if "tiktok.com" in url_lower:
-        # Eliminar parámetros de tracking comunes
-        url = re.sub(r'[?&](lang|q|t|is_from_webapp|is_from_ads)=[^&]*', '', url)
-        url = url.rstrip('?&')
+    result = run_task_process(task_id, ffmpeg_cmd, TRANSCODE_TIMEOUT)
+    if result.returncode != 0:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise Exception(f"No se pudo convertir el audio: {result.stderr[-500:]}")
     
-    return url
+    os.replace(out_path, dst_path)
+    if dst_path != src_path and os.path.exists(src_path):
+        os.remove(src_path)
+    return dst_path
+
+def remember_source(cache_dir: str, key: str, remote_url: str, sources: dict):
+    """Asocia una clave de caché a su URL remota, en memoria y en un archivo <clave>.url junto
+    al archivo cacheado, para que los enlaces ya entregados sigan funcionando tras un reinicio"""
+    if sources.get(key) == remote_url:
+        return
+    sources[key] = remote_url
+    path = os.path.join(cache_dir, f"{key}.url")
+    if os.path.exists(path):
+        return
+    try:
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(remote_url)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Warning: No se pudo guardar el origen de {key}: {e}")
+
+def lookup_source(cache_dir: str, key: str, sources: dict):
+    """URL remota de una clave de caché (de memoria o de su archivo <clave>.url), o None"""
+    remote_url = sources.get(key)
+    if remote_url is None:
+        try:
+            with open(os.path.join(cache_dir, f"{key}.url"), encoding="utf-8") as f:
+                remote_url = sources[key] = f.read().strip()
+        except OSError:
+            return None
+    return remote_url
+
+def proxied_sprite_url(remote_url: str):
+    """Registra la URL de un sprite y devuelve la ruta local que lo sirve desde caché.
+    URLs de hosts no permitidos se devuelven sin cambios."""
+    if not remote_url:
+        return remote_url
+    parsed = urlparse(remote_url)
+    if parsed.scheme not in ("http", "https") or parsed.hostname not in SPRITE_ALLOWED_HOSTS:
+        return remote_url
+    key = hashlib.sha256(remote_url.encode("utf-8")).hexdigest()[:32]
+    ext = os.path.splitext(parsed.path)[1].lower() or ".png"
+    remember_source(SPRITE_CACHE_DIR, key, remote_url, sprite_sources)
+    return url_for("serve_sprite", filename=f"{key}{ext}")
+
+def fetch_sprite(key: str, ext: str):
+    """Devuelve la ruta en disco del sprite, descargándolo la primera vez (o None si no existe)"""
+    path = os.path.join(SPRITE_CACHE_DIR, f"{key}{ext}")
+    if os.path.exists(path):
+        return path
+    
+    remote_url = lookup_source(SPRITE_CACHE_DIR, key, sprite_sources)
+    if not remote_url or urlparse(remote_url).hostname not in SPRITE_ALLOWED_HOSTS:
+        return None
+    
+    # Un lock por sprite para que requests simultáneos lo descarguen una sola vez
+    with sprite_locks_guard:
+        lock = sprite_locks.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            if not os.path.exists(path):
+                r = requests.get(remote_url, timeout=15)
+                r.raise_for_status()
+                temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(r.content)
+                os.replace(temp_path, path)
+    finally:
+        with sprite_locks_guard:
+            sprite_locks.pop(key, None)
+    return path
+
+@contextmanager
+def preview_lock(key: str):
+    """Un lock por vista previa para que requests simultáneos la generen una sola vez"""
+    with preview_locks_guard:
+        lock = preview_locks.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            yield
+    finally:
+        with preview_locks_guard:
+            preview_locks.pop(key, None)
+
+def proxied_thumbnail_url(remote_url: str):
+    """Registra la miniatura remota y devuelve la ruta local que la sirve reducida.
+    En modo distribuido se devuelve la URL remota: la caché es de cada nodo y el request
+    de la miniatura puede llegar a otro."""
+    if CLUSTER_DB or not remote_url or urlparse(remote_url).scheme not in ("http", "https"):
+        return remote_url
+    key = hashlib.sha256(f"thumbnail:{remote_url}".encode("utf-8")).hexdigest()[:32]
+    remember_source(PREVIEW_CACHE_DIR, key, remote_url, thumbnail_sources)
+    return f"/previews/{key}.jpg"
+
+def preview_strip_url(filename: str) -> str:
+    return f"/api/previews/strip/{quote(filename)}"
+
+def fetch_thumbnail(key: str):
+    """Devuelve la ruta de la miniatura reducida, descargándola y reduciéndola la primera vez"""
+    path = os.path.join(PREVIEW_CACHE_DIR, f"{key}.jpg")
+    if os.path.exists(path):
+        return path
+    remote_url = lookup_source(PREVIEW_CACHE_DIR, key, thumbnail_sources)
+    if not remote_url:
+        return None
+    
+    with preview_lock(key):
+        if not os.path.exists(path):
+            r = requests.get(remote_url, timeout=15, stream=True)
+            r.raise_for_status()
+            content = r.raw.read(THUMBNAIL_MAX_BYTES + 1, decode_content=True)
+            if len(content) > THUMBNAIL_MAX_BYTES:
+                raise ValueError("La miniatura es demasiado grande")
+            # ffmpeg ya es dependencia: reduce y convierte a JPEG (las miniaturas suelen ser WebP)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            result = subprocess.run(
+                ['ffmpeg', '-v', 'error', '-i', 'pipe:0', '-vf', f"scale='min({THUMBNAIL_WIDTH},iw)':-2",
+                 '-frames:v', '1', '-q:v', '4', '-f', 'image2', '-c:v', 'mjpeg', '-y', temp_path],
+                input=content, capture_output=True, timeout=30
+            )
+            if result.returncode != 0:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise ValueError(f"No se pudo reducir la miniatura: {result.stderr.decode(errors='replace')[-300:]}")
+            os.replace(temp_path, path)
+    return path
+
+def build_keyframe_strip(filename: str, frames: int = STRIP_FRAMES) -> dict:
+    """Genera (una sola vez) una tira horizontal de fotogramas clave de una descarga completada.
+    Solo se decodifican fotogramas clave (-skip_frame nokey), así que es rápido incluso en videos largos."""
+    path = os.path.join(DOWNLOAD_DIR, filename)
+    stat = os.stat(path)
+    key = hashlib.sha256(
+        f"strip:{filename}:{stat.st_size}:{stat.st_mtime_ns}:{frames}:{STRIP_FRAME_WIDTH}".encode("utf-8")
+    ).hexdigest()[:32]
+    meta_path = os.path.join(PREVIEW_CACHE_DIR, f"{key}.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f)
+    
+    with preview_lock(key):
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        
+        # ffmpeg -i sin salida termina con error, pero imprime la duración de la cabecera
+        probe = subprocess.run(['ffmpeg', '-hide_banner', '-i', path], capture_output=True, text=True, timeout=30)
+        match = FFMPEG_DURATION_RE.search(probe.stderr)
+        duration = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3)) if match else 0
+        if duration <= 0:
+            raise ValueError("No se pudo leer la duración del video")
+        interval = duration / frames
+        
+        image_path = os.path.join(PREVIEW_CACHE_DIR, f"{key}.jpg")
+        temp_path = f"{image_path}.{uuid.uuid4().hex}.tmp"
+        ffmpeg_cmd = [
+            'ffmpeg', '-v', 'error',
+            '-skip_frame', 'nokey',  # Solo fotogramas clave
+            '-i', path, '-an', '-sn',
+            '-vf', f"fps=1/{interval:.6f},scale={STRIP_FRAME_WIDTH}:-2,tile={frames}x1",
+            '-frames:v', '1', '-q:v', '5', '-f', 'image2', '-c:v', 'mjpeg', '-y', temp_path
+        ]
+        # Comparte el límite de CPU con las recodificaciones de audio
+        with transcode_slots:
+            result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=300)
+        if result.returncode != 0 or not os.path.exists(temp_path):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise ValueError(f"No se pudo generar la vista previa: {result.stderr[-300:]}")
+        os.replace(temp_path, image_path)
+        
+        meta = {
+            "url": f"/previews/{key}.jpg",
+            "frames": frames,
+            "interval": round(interval, 3),
+            "duration": round(duration, 3),
+            "frame_width": STRIP_FRAME_WIDTH,
+        }
+        temp_meta = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_meta, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(temp_meta, meta_path)
+    return meta
+
+def remember_completed_download(url: str, filename: str):
+    """Recuerda el archivo completo de una URL para ofrecer su tira al elegir un recorte"""
+    key = canonical_url(url)
+    with completed_downloads_lock:
+        completed_downloads[key] = filename
+        completed_downloads.move_to_end(key)
+        while len(completed_downloads) > COMPLETED_DOWNLOADS_SIZE:
+            completed_downloads.popitem(last=False)
+
+def forget_completed_download(filename: str):
+    """Olvida las URLs asociadas a un nombre que se acaba de publicar: si el nombre se reutiliza
+    (el archivo anterior ya se borró), el archivo nuevo no es la descarga completa de esas URLs"""
+    with completed_downloads_lock:
+        for key in [key for key, name in completed_downloads.items() if name == filename]:
+            del completed_downloads[key]
 
 def cleanup_old_files():
     """Elimina archivos antiguos del directorio de descargas"""
@@ -152,30 +849,339 @@ def cleanup_old_files():
                 except Exception:
                     pass
         
-        return deleted_count
+        # Las vistas previas siguen la vida de las descargas (una miniatura borrada se regenera)
+        for filename in os.listdir(PREVIEW_CACHE_DIR):
+            file_path = os.path.join(PREVIEW_CACHE_DIR, filename)
+            try:
+                if current_time - os.path.getmtime(file_path) > max_age_seconds:
+                    os.remove(file_path)
+            except OSError:
+                pass
+        
+        # Modo distribuido: olvidar los archivos borrados y las tareas terminadas hace tiempo
+        if CLUSTER_DB:
+            conn = cluster_connection()
+            conn.execute("DELETE FROM artifacts WHERE node_id = ? AND created < ?", (NODE_ID, current_time - max_age_seconds))
+            conn.execute(
+                f"DELETE FROM jobs WHERE created < ? AND status IN ({','.join('?' * len(FINAL_STATUSES))})",
+                (current_time - max_age_seconds, *cluster_final_statuses())
+            )
+        
+        return deleted_count + collect_orphan_partials()
     except Exception:
         return 0
 
+def journal_path(task_id: str) -> str:
+    return os.path.join(TASK_JOURNAL_DIR, f"{task_id}.json")
+
+def lock_journal_file(handle) -> bool:
+    """Bloquea una entrada del diario sin esperar. El sistema operativo libera el lock
+    cuando el proceso muere, así que una entrada sin lock es una tarea huérfana."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+def journal_task(task_id: str, **fields):
+    """Crea o actualiza la entrada del diario de una tarea.
+    Se reescribe en el mismo archivo para no perder el lock que la marca como viva."""
+    try:
+        with journal_lock:
+            handle, entry = journal_handles.get(task_id, (None, {}))
+            if handle is None:
+                handle = open(journal_path(task_id), "w+", encoding="utf-8")
+                lock_journal_file(handle)
+            entry.update(fields)
+            journal_handles[task_id] = (handle, entry)
+            handle.seek(0)
+            handle.truncate()
+            json.dump(entry, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Warning: No se pudo escribir el diario de la tarea {task_id}: {e}")
+
+def journal_remove(task_id: str):
+    """Borra la entrada del diario de una tarea terminada (con éxito o con error)"""
+    with journal_lock:
+        handle, _ = journal_handles.pop(task_id, (None, None))
+    try:
+        # Primero se borra y luego se suelta el lock, para que nadie reclame una tarea terminada
+        os.remove(journal_path(task_id))
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # Windows no permite borrar un archivo abierto
+        if handle:
+            handle.close()
+            handle = None
+        try:
+            os.remove(journal_path(task_id))
+        except OSError:
+            pass
+    if handle:
+        handle.close()
+
+def read_journal_entries() -> dict:
+    """Lee todas las entradas del diario (de este y de otros procesos) sin bloquearlas"""
+    entries = {}
+    for entry_name in os.listdir(TASK_JOURNAL_DIR):
+        if not entry_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(TASK_JOURNAL_DIR, entry_name), encoding="utf-8") as f:
+                entries[entry_name[:-5]] = json.load(f)
+        except (OSError, ValueError):
+            continue
+    return entries
+
+def collect_orphan_partials() -> int:
+    """Elimina archivos parciales y directorios de trabajo que no pertenecen a ninguna tarea
+    del diario. Lo modificado recientemente se conserva: puede ser de una descarga en curso
+    que todavía no registró su nombre."""
+    entries = read_journal_entries()
+    prefixes = tuple(
+        entry["prefix"] + "." for entry in entries.values()
+        if isinstance(entry, dict) and entry.get("prefix")
+    )
+    current_time = time.time()
+    deleted_count = 0
+    for task_id in os.listdir(SCRATCH_DIR):
+        task_dir = os.path.join(SCRATCH_DIR, task_id)
+        if task_id in entries or task_id in download_progress or not os.path.isdir(task_dir):
+            continue
+        try:
+            mtimes = [os.path.getmtime(os.path.join(task_dir, f)) for f in os.listdir(task_dir)]
+            if current_time - max(mtimes, default=os.path.getmtime(task_dir)) > PARTIAL_GRACE_SECONDS:
+                deleted_count += remove_task_scratch(task_id)
+        except OSError:
+            pass
+    for filename in os.listdir(DOWNLOAD_DIR):
+        file_path = os.path.join(DOWNLOAD_DIR, filename)
+        if not (PARTIAL_FILE_RE.search(filename) or PUBLISH_TEMP_RE.match(filename)) or not os.path.isfile(file_path):
+            continue
+        if prefixes and filename.startswith(prefixes):
+            continue
+        try:
+            if current_time - os.path.getmtime(file_path) > PARTIAL_GRACE_SECONDS:
+                os.remove(file_path)
+                deleted_count += 1
+        except OSError:
+            pass
+    return deleted_count
+
+def resume_journaled_tasks() -> int:
+    """Reencola las tareas del diario cuyo proceso ya no existe (reinicio, deploy, caída).
+    yt-dlp continúa desde el .part existente porque la tarea vuelve a generar el mismo nombre."""
+    resumed = 0
+    for entry_name in os.listdir(TASK_JOURNAL_DIR):
+        task_id = entry_name[:-5]
+        if not entry_name.endswith(".json") or task_id in journal_handles:
+            continue
+        path = os.path.join(TASK_JOURNAL_DIR, entry_name)
+        try:
+            handle = open(path, "r+", encoding="utf-8")
+        except OSError:
+            continue
+        # Sin lock: la tarea pertenece a otro proceso vivo. Sin enlaces: terminó mientras la abríamos
+        if not lock_journal_file(handle) or os.fstat(handle.fileno()).st_nlink == 0:
+            handle.close()
+            continue
+        try:
+            entry = json.loads(handle.read())
+            url, quality = entry["url"], entry["quality"]
+        except (ValueError, KeyError, TypeError):
+            # Entrada incompleta: el proceso murió mientras la escribía
+            handle.close()
+            if time.time() - os.path.getmtime(path) > PARTIAL_GRACE_SECONDS:
+                os.remove(path)
+            continue
+
+        with journal_lock:
+            journal_handles[task_id] = (handle, entry)
+        if CLUSTER_DB:
+            # En modo distribuido la cola compartida es el registro durable: la tarea vuelve a la
+            # cola cuando vence el latido del proceso anterior (y si este nodo la toma, reanuda el .part)
+            journal_remove(task_id)
+            continue
+        state = download_progress[task_id] = TaskState()
+        if entry.get("resumes", 0) >= TASK_MAX_RESUMES:
+            state.update(TaskStatus.ERROR, 0, "La descarga se interrumpió demasiadas veces. Intenta nuevamente.")
+            download_results[task_id] = {"error": state.message}
+            journal_remove(task_id)
+            continue
+        journal_task(task_id, resumes=entry.get("resumes", 0) + 1)
+        state.update(TaskStatus.QUEUED, 0, "Reanudando descarga...")
+        schedule_download(task_id, url, quality, entry.get("start_time"), entry.get("end_time"),
+                          client=entry.get("client", "local"), cost=entry.get("cost"))
+        resumed += 1
+
+    collect_orphan_partials()
+    if resumed:
+        print(f"Reanudando {resumed} descarga(s) interrumpida(s)")
+    return resumed
+
+def project_pokemon(data: dict, name: str) -> dict:
+    """Extrae de la respuesta de PokeAPI solo lo que muestra la aplicación"""
+    sprites = data.get("sprites") or {}
+    return {
+        "id": data.get("id"),
+        "name": data.get("name", name),
+        "types": [t["type"]["name"] for t in data.get("types", [])],
+        "moves": [m["move"]["name"] for m in data.get("moves", [])],
+        "sprites": {key: sprites.get(key) for key in SPRITE_KEYS},
+    }
+
+def parse_pokemon_payload(text: str, name: str) -> dict:
+    """Parseo parcial de la respuesta de PokeAPI.
+
+    En lugar de construir todo el árbol (game_indices, version_group_details,
+    sprites por versión, etc.) localiza con expresiones regulares solo las claves
+    que usa la aplicación y decodifica esos valores con raw_decode. Si la
+    estructura no es la esperada, usa json.loads como respaldo."""
+    types_at = [m.end() for m in TYPES_KEY_RE.finditer(text)]
+    sprites_at = [m.end() for m in SPRITES_KEY_RE.finditer(text)]
+    ids = ID_KEY_RE.findall(text)
+    # Con ids numéricos hace falta el nombre real; con claves ambiguas (p.ej. past_types) no hay atajo
+    if name.isdigit() or len(types_at) != 1 or len(sprites_at) != 1:
+        return project_pokemon(json.loads(text), name)
+    
+    try:
+        moves = [_json_decoder.raw_decode(text, m.end())[0]["name"] for m in MOVE_KEY_RE.finditer(text)]
+        # Cada movimiento tiene exactamente un version_group_details
+        if len(moves) != text.count('"version_group_details"'):
+            return project_pokemon(json.loads(text), name)
+        types = _json_decoder.raw_decode(text, types_at[0])[0]
+        sprites = _json_decoder.raw_decode(text, sprites_at[0])[0]
+    except (ValueError, KeyError, TypeError):
+        return project_pokemon(json.loads(text), name)
+    
+    return {
+        "id": int(ids[0]) if len(ids) == 1 else None,
+        "name": name,
+        "types": [t["type"]["name"] for t in types],
+        "moves": moves,
+        "sprites": {key: sprites.get(key) for key in SPRITE_KEYS},
+    }
+
+def snapshot_connection() -> sqlite3.Connection:
+    """Conexión de solo lectura al snapshot; se reabre si el archivo fue reconstruido"""
+    mtime = os.stat(POKEAPI_SNAPSHOT).st_mtime_ns
+    conn = getattr(_snapshot_local, "conn", None)
+    if conn is None or _snapshot_local.mtime != mtime:
+        if conn is not None:
+            conn.close()
+        conn = sqlite3.connect(Path(POKEAPI_SNAPSHOT).resolve().as_uri() + "?mode=ro", uri=True)
+        conn.execute(f"PRAGMA mmap_size={SNAPSHOT_MMAP_SIZE}")
+        _snapshot_local.conn, _snapshot_local.mtime = conn, mtime
+    return conn
+
+def snapshot_get(name: str):
+    """Busca un Pokémon (por nombre o id) en el snapshot local"""
+    conn = snapshot_connection()
+    if name.isdigit():
+        row = conn.execute("SELECT data FROM pokemon WHERE id = ?", (int(name),)).fetchone()
+    else:
+        row = conn.execute("SELECT data FROM pokemon WHERE name = ?", (name,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def snapshot_names() -> list:
+    """Todos los nombres del snapshot, ordenados por id (se cachean hasta que cambie el archivo)"""
+    conn = snapshot_connection()
+    if _snapshot_names["mtime"] != _snapshot_local.mtime:
+        names = [row[0] for row in conn.execute("SELECT name FROM pokemon ORDER BY id")]
+        _snapshot_names.update(mtime=_snapshot_local.mtime, names=names)
+    return _snapshot_names["names"]
+
+def build_pokemon_snapshot(output: str, projections) -> int:
+    """Escribe un snapshot nuevo a partir de proyecciones y lo reemplaza de forma atómica"""
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    temp_path = f"{output}.{uuid.uuid4().hex}.tmp"
+    conn = sqlite3.connect(temp_path)
+    try:
+        conn.execute("CREATE TABLE pokemon (name TEXT PRIMARY KEY, id INTEGER, data TEXT NOT NULL) WITHOUT ROWID")
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        count = 0
+        for projection in projections:
+            conn.execute(
+                "INSERT OR REPLACE INTO pokemon (name, id, data) VALUES (?, ?, ?)",
+                (projection["name"], projection.get("id"), json.dumps(projection, separators=(",", ":")))
+            )
+            count += 1
+        conn.execute("CREATE INDEX pokemon_id ON pokemon (id)")
+        conn.execute("INSERT INTO meta VALUES ('built_at', ?), ('count', ?)", (datetime.now().isoformat(), str(count)))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(temp_path, output)
+    return count
+
+def fetch_pokemon(name: str):
+    """Consulta un Pokémon en PokeAPI (o en el snapshot local en modo offline).
+    Devuelve la proyección o None si no existe.
+    Lanza requests.RequestException si PokeAPI no responde."""
+    if POKEAPI_OFFLINE:
+        try:
+            return snapshot_get(name)
+        except (sqlite3.Error, OSError) as e:
+            raise requests.RequestException(f"Snapshot local de PokeAPI no disponible: {e}") from e
+    
+    now = time.monotonic()
+    with pokemon_cache_lock:
+        cached = pokemon_cache.get(name)
+        if cached and cached[0] > now:
+            pokemon_cache.move_to_end(name)
+            return cached[1]
+    
+    r = pokeapi_session.get(f"{POKEAPI_BASE_URL}/pokemon/{name}", timeout=15)
+    if r.status_code != 200:
+        return None
+    projection = parse_pokemon_payload(r.text, name)
+    
+    with pokemon_cache_lock:
+        pokemon_cache[name] = (now + POKEMON_CACHE_TTL, projection)
+        pokemon_cache.move_to_end(name)
+        while len(pokemon_cache) > POKEMON_CACHE_SIZE:
+            pokemon_cache.popitem(last=False)
+    return projection
+
+def with_proxied_sprites(projection: dict) -> dict:
+    """Copia de la proyección con los sprites apuntando a la caché local"""
+    return {
+        **projection,
+        "sprites": {key: proxied_sprite_url(url) for key, url in projection["sprites"].items()},
+    }
+
+def list_pokemon_names() -> list:
+    """Lista de todos los nombres de Pokémon (de PokeAPI o del snapshot en modo offline)"""
+    if POKEAPI_OFFLINE:
+        return snapshot_names()
+    
+    # Obtener el total de Pokémon disponibles
+    url = f"{POKEAPI_BASE_URL}/pokemon?limit=1"
+    r = requests.get(url, timeout=15)
+    if r.status_code != 200:
+        return []
+    
+    # Obtener el count total
+    total_count = r.json().get("count", 1000)
+    
+    # Obtener lista de todos los Pokémon
+    url_all = f"{POKEAPI_BASE_URL}/pokemon?limit={total_count}"
+    r_all = requests.get(url_all, timeout=15)
+    if r_all.status_code != 200:
+        return []
+    
+    data = r_all.json()
+    return [p["name"] for p in data.get("results", [])]
+
 def find_similar_pokemon(query: str, limit: int = 10) -> list:
     """Busca Pokémon similares al texto ingresado"""
     try:
-        # Obtener el total de Pokémon disponibles
-        url = "https://pokeapi.co/api/v2/pokemon?limit=1"
-        r = requests.get(url, timeout=15)
-        if r.status_code != 200:
-            return []
-        
-        # Obtener el count total
-        total_count = r.json().get("count", 1000)
-        
-        # Obtener lista de todos los Pokémon
-        url_all = f"https://pokeapi.co/api/v2/pokemon?limit={total_count}"
-        r_all = requests.get(url_all, timeout=15)
-        if r_all.status_code != 200:
-            return []
-        
-        data = r_all.json()
-        all_pokemon_names = [p["name"] for p in data.get("results", [])]
+        all_pokemon_names = list_pokemon_names()
         
         # Buscar coincidencias parciales (que contengan el texto)
         partial_matches = [name for name in all_pokemon_names if query.lower() in name.lower()]
@@ -193,54 +1199,109 @@ def find_similar_pokemon(query: str, limit: int = 10) -> list:
 def detect_platform(url: str) -> dict:
     """Detecta la plataforma de la URL para mostrar información visual.
     yt-dlp maneja automáticamente todas las plataformas soportadas."""
-    url_lower = url.lower()
-    
-    # YouTube
-    if "youtube.com" in url_lower or "youtu.be" in url_lower or "m.youtube.com" in url_lower:
-        return {
-            "name": "YouTube",
-            "icon": "▶",
-            "color": "#FF0000"
-        }
-    
-    # TikTok
-    if "tiktok.com" in url_lower or "vm.tiktok.com" in url_lower:
-        return {
-            "name": "TikTok",
-            "icon": "🎵",
-            "color": "#000000"
-        }
-    
-    # Instagram
-    if "instagram.com" in url_lower or "instagr.am" in url_lower:
-        return {
-            "name": "Instagram",
-            "icon": "📷",
-            "color": "#E4405F"
-        }
-    
-    # Facebook
-    if "facebook.com" in url_lower or "fb.com" in url_lower:
-        return {
-            "name": "Facebook",
-            "icon": "👥",
-            "color": "#1877F2"
-        }
-    
-    # Twitter/X
-    if "twitter.com" in url_lower or "x.com" in url_lower:
-        return {
-            "name": "Twitter/X",
-            "icon": "🐦",
-            "color": "#1DA1F2"
+    platform = classify_url(url).platform
+    # Copia: el resultado se guarda en download_results y no debe compartir el dict de la tabla
+    return dict(PLATFORMS[platform] if platform else GENERIC_PLATFORM)
+
+class StackSampler:
+    """Profiler de muestreo: un hilo lee periódicamente los frames de los demás hilos
+    y acumula las pilas en formato "collapsed" (compatible con flamegraph.pl / speedscope)."""
+
+    def __init__(self, interval: float = 0.005, thread_ids: set = None, exclude_ids: set = None):
+        self.interval = interval
+        self.thread_ids = thread_ids  # None = todos los hilos
+        self.exclude_ids = set(exclude_ids or ())
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        ignored = self.exclude_ids | {threading.get_ident()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in ignored or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        return self
+
+    def collapsed(self) -> str:
+        """Una línea por pila: "frame;frame;frame conteo" """
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+def profile_process(seconds: float, interval: float = 0.005, exclude: set = None) -> StackSampler:
+    """Muestrea todos los hilos del proceso durante `seconds` segundos"""
+    sampler = StackSampler(interval, exclude_ids=exclude).start()
+    time.sleep(seconds)
+    return sampler.stop()
+
+def profiled(view):
+    """Perfila un request cuando PROFILING_ENABLED está activo y llega el header X-Profile.
+    La respuesta no cambia; el perfil se consulta con el id del header X-Profile-Id."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not PROFILING_ENABLED or not request.headers.get(PROFILE_HEADER):
+            return view(*args, **kwargs)
+        
+        interval = PROFILE_REQUEST_INTERVAL
+        sampler = StackSampler(interval, thread_ids={threading.get_ident()}).start()
+        start = time.perf_counter()
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        finally:
+            sampler.stop()
+            elapsed_ms = round((time.perf_counter() - start) * 1000, 3)
+        
+        profile_id = uuid.uuid4().hex
+        if len(request_profile_ids) == request_profile_ids.maxlen:
+            request_profiles.pop(request_profile_ids[0], None)
+        request_profile_ids.append(profile_id)
+        request_profiles[profile_id] = {
+            "endpoint": request.path,
+            "method": request.method,
+            "elapsed_ms": elapsed_ms,
+            "samples": sampler.samples,
+            "interval_ms": interval * 1000,
+            "collapsed": sampler.collapsed(),
         }
-    
-    # Otras plataformas - yt-dlp las manejará automáticamente
-    return {
-        "name": "Video",
-        "icon": "🎬",
-        "color": "#666666"
-    }
+        response.headers["X-Profile-Id"] = profile_id
+        response.headers["X-Profile-Elapsed-Ms"] = str(elapsed_ms)
+        return response
+    return wrapper
+
+def handle_profile_signal(signum, frame):
+    """SIGUSR1: perfila el proceso en segundo plano y guarda el resultado en PROFILE_OUTPUT_DIR"""
+    def run():
+        sampler = profile_process(PROFILE_SIGNAL_SECONDS)
+        os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_OUTPUT_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(sampler.collapsed() + "\n")
+        print(f"Perfil guardado en {path} ({sampler.samples} muestras)")
+    threading.Thread(target=run, name="signal-profiler", daemon=True).start()
+
+if PROFILING_ENABLED and hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGUSR1, handle_profile_signal)
 
 @app.context_processor
 def inject_globals():
@@ -254,6 +1315,7 @@ def index():
 # Pregunta 1: Pokémon
 # -----------------------
 @app.route("/pokemon", methods=["GET", "POST"])
+@profiled
 def pokemon():
     context = {"title": "Pokémon", "query": None, "pokemon": None, "error": None, "suggestions": None}
     if request.method == "POST":
@@ -263,10 +1325,9 @@ def pokemon():
             context["error"] = "Ingresa un nombre."
             return render_template("pokemon.html", **context)
 
-        url = f"https://pokeapi.co/api/v2/pokemon/{name}"
         try:
-            r = requests.get(url, timeout=15)
-            if r.status_code != 200:
+            projection = fetch_pokemon(name)
+            if projection is None:
                 # Buscar Pokémon similares
                 suggestions = find_similar_pokemon(name, limit=10)
                 if suggestions:
@@ -276,386 +1337,1328 @@ def pokemon():
                     context["error"] = f"No se encontró el Pokémon '{name}' y no hay sugerencias disponibles."
                 return render_template("pokemon.html", **context)
 
-            data = r.json()
-            types = [t["type"]["name"] for t in data.get("types", [])]
-            moves = [m["move"]["name"] for m in data.get("moves", [])]
-            sprites = {
-                "front_default": data.get("sprites", {}).get("front_default"),
-                "front_shiny": data.get("sprites", {}).get("front_shiny"),
-                "back_default": data.get("sprites", {}).get("back_default"),
-                "back_shiny": data.get("sprites", {}).get("back_shiny"),
-            }
-
+            # Los sprites se sirven desde la caché local en lugar de enlazar a GitHub
+            projection = with_proxied_sprites(projection)
+            # Solo se renderiza la primera página de movimientos; el resto se carga desde
+            # /api/pokemon/<name>/moves a medida que se hace scroll
             context.update({
-                "pokemon": {"name": data.get("name", name)},
-                "types": types,
-                "moves": moves,
-                "sprites": sprites,
+                "pokemon": {"name": projection["name"]},
+                "types": projection["types"],
+                "moves": projection["moves"][:MOVES_PAGE_SIZE],
+                "moves_total": len(projection["moves"]),
+                "moves_page_size": MOVES_PAGE_SIZE,
+                "sprites": projection["sprites"],
             })
         except requests.RequestException as e:
             context["error"] = f"Error consultando PokeAPI: {e}"
     return render_template("pokemon.html", **context)
 
+def fetch_pokemon_result(name: str) -> dict:
+    """Resultado de un nombre dentro de una consulta en lote (nunca lanza excepción)"""
+    try:
+        projection = fetch_pokemon(name)
+    except requests.RequestException as e:
+        return {"name": name, "error": f"Error consultando PokeAPI: {e}"}
+    if projection is None:
+        return {"name": name, "error": "No encontrado"}
+    return {"name": name, "pokemon": projection}
+
+@app.route("/api/pokemon", methods=["GET", "POST"])
+def api_pokemon_batch():
+    """Consulta varios Pokémon a la vez.
+
+    GET /api/pokemon?names=a,b,c  o  POST /api/pokemon {"names": [...]}.
+    Los nombres repetidos se consultan una vez y en paralelo. Con más de
+    POKEMON_STREAM_THRESHOLD nombres (o Accept: application/x-ndjson) la respuesta
+    es NDJSON, una línea por Pokémon en el orden en que terminan."""
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        raw_names = data.get("names") or []
+        if isinstance(raw_names, str):
+            raw_names = raw_names.split(",")
+        if not isinstance(raw_names, list):
+            return jsonify({"error": "names debe ser una lista"}), 400
+    else:
+        raw_names = (request.args.get("names") or "").split(",")
+    
+    # Normalizar y eliminar duplicados manteniendo el orden
+    names = list(dict.fromkeys(str(n).strip().lower() for n in raw_names if str(n).strip()))
+    if not names:
+        return jsonify({"error": "Indica al menos un nombre"}), 400
+    if len(names) > POKEMON_BATCH_LIMIT:
+        return jsonify({"error": f"Máximo {POKEMON_BATCH_LIMIT} nombres por consulta"}), 400
+    
+    futures = {pokeapi_pool.submit(fetch_pokemon_result, name): name for name in names}
+    
+    def finish(result: dict) -> dict:
+        # url_for necesita el contexto del request, por eso los sprites se resuelven aquí
+        if "pokemon" in result:
+            result["pokemon"] = with_proxied_sprites(result["pokemon"])
+        return result
+    
+    wants_stream = "application/x-ndjson" in request.headers.get("Accept", "")
+    if wants_stream or len(names) > POKEMON_STREAM_THRESHOLD:
+        def generate():
+            for future in as_completed(futures):
+                yield json.dumps(finish(future.result()), ensure_ascii=False) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    
+    results = {futures[f]: finish(f.result()) for f in as_completed(futures)}
+    ordered = [results[name] for name in names]
+    return jsonify({
+        "results": ordered,
+        "count": len(ordered),
+        "errors": sum(1 for r in ordered if "error" in r),
+    })
+
+@app.route("/api/pokemon/<name>/moves")
+def api_pokemon_moves(name):
+    """Página de movimientos de un Pokémon: ?offset=0&limit=40"""
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+        limit = min(max(int(request.args.get("limit", MOVES_PAGE_SIZE)), 1), 200)
+    except ValueError:
+        return jsonify({"error": "offset y limit deben ser enteros"}), 400
+    
+    name = name.strip().lower()
+    try:
+        projection = fetch_pokemon(name)
+    except requests.RequestException as e:
+        return jsonify({"error": f"Error consultando PokeAPI: {e}"}), 502
+    if projection is None:
+        return jsonify({"error": "No encontrado"}), 404
+    
+    moves = projection["moves"]
+    next_offset = offset + limit
+    return jsonify({
+        "name": projection["name"],
+        "count": len(moves),
+        "offset": offset,
+        "limit": limit,
+        "moves": moves[offset:next_offset],
+        "next": url_for("api_pokemon_moves", name=name, offset=next_offset, limit=limit) if next_offset < len(moves) else None,
+    })
+
+@app.route("/sprites/<filename>")
+def serve_sprite(filename):
+    """Sirve un sprite desde la caché local con cabeceras de caché inmutables"""
+    key, ext = os.path.splitext(filename)
+    if not re.fullmatch(r"[0-9a-f]{32}", key) or not re.fullmatch(r"\.[a-z0-9]{1,5}", ext) or ext == ".url":
+        return jsonify({"error": "Sprite no encontrado"}), 404
+    
+    try:
+        path = fetch_sprite(key, ext)
+    except requests.RequestException as e:
+        return jsonify({"error": f"Error descargando sprite: {e}"}), 502
+    if path is None:
+        return jsonify({"error": "Sprite no encontrado"}), 404
+    
+    # La clave depende solo de la URL remota, cuyo contenido no cambia: sirve como ETag
+    response = send_file(
+        path,
+        mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        etag=key,
+        max_age=SPRITE_MAX_AGE,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 # -----------------------
 # Pregunta 2: Descarga video
 # -----------------------
 
-def download_video_task(task_id: str, url: str, quality: str, start_time: float = None, end_time: float = None):
-    """Función que ejecuta la descarga de video en un hilo separado"""
+def otlp_value(value) -> dict:
+    """Valor de atributo tipado de OTLP/JSON (los enteros van como string, como en protobuf)"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def otlp_export_request(span: dict) -> dict:
+    """Un span como ExportTraceServiceRequest de OTLP/JSON (una línea del file exporter del Collector)"""
+    otlp_span = {
+        "traceId": span["trace_id"],
+        "spanId": span["span_id"],
+        "name": span["name"],
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(span["start_time_unix_nano"]),
+        "endTimeUnixNano": str(span["end_time_unix_nano"]),
+        "attributes": [
+            {"key": key, "value": otlp_value(value)}
+            for key, value in span["attributes"].items() if value is not None
+        ],
+        "status": {"code": OTLP_STATUS_CODES[span["status"]["code"]], "message": span["status"]["message"]},
+    }
+    if span["parent_span_id"]:
+        otlp_span["parentSpanId"] = span["parent_span_id"]
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "lab06.downloads"}, "spans": [otlp_span]}],
+        }]
+    }
+
+def export_span(span: dict):
+    """Guarda un span terminado en el buffer circular y, si está configurado, en el archivo JSONL (OTLP/JSON)"""
+    with trace_lock:
+        trace_spans.append(span)
+        if TRACE_EXPORT_FILE:
+            try:
+                with open(TRACE_EXPORT_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(otlp_export_request(span)) + "\n")
+            except OSError as e:
+                print(f"Warning: No se pudo exportar el span: {e}")
+
+@contextmanager
+def task_span(task_id: str, name: str, **attributes):
+    """Registra un span por etapa de una tarea de descarga.
+
+    Los spans anidados dentro del mismo hilo heredan trace_id y parent_span_id.
+    Se entrega el diccionario de atributos para que la etapa agregue datos
+    (por ejemplo, bytes descargados) antes de cerrar el span."""
+    stack = getattr(_trace_context, "stack", None)
+    if stack is None:
+        stack = _trace_context.stack = []
+    parent = stack[-1] if stack else None
+    span = {
+        "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_span_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start_time_unix_nano": time.time_ns(),
+        "end_time_unix_nano": None,
+        "duration_ms": None,
+        "attributes": {"task_id": task_id, **attributes},
+        "status": {"code": "OK", "message": ""},
+    }
+    stack.append(span)
+    start = time.perf_counter()
     try:
-        # Actualizar estado inicial
-        download_progress[task_id] = {
-            "status": "starting",
-            "percent": 0,
-            "message": "Iniciando descarga..."
-        }
-        
-        clean_url = clean_youtube_url(url)
-        is_youtube = "youtube.com" in clean_url.lower() or "youtu.be" in clean_url.lower()
-        
-        # Configurar opciones de descarga
-        download_opts = {
-            'outtmpl': os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True,
-            'socket_timeout': 30,
-            'retries': 3,  # Reintentar hasta 3 veces
-            'fragment_retries': 3,
-            'noprogress': True,  # No mostrar barra de progreso en consola
-            'suppress_warnings': True,  # Suprimir todas las advertencias
-        }
-        
-        # Determinar formato según calidad solicitada
-        postprocessors = []
-        
-        if quality == "audio":
-            download_opts['format'] = 'bestaudio/best'
-            postprocessors.append({
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            })
-        elif quality.startswith("height_"):
-            # Extraer altura (ej: "height_720" -> 720)
-            height = int(quality.replace("height_", ""))
-            # Para formatos específicos de altura, usar bestvideo+bestaudio para combinar
-            # Usar height>= para encontrar el mejor formato disponible desde esa altura hacia arriba
-            # Si no hay formato exacto, buscar el más cercano disponible
-            # Esto es especialmente importante para 4K donde video y audio están separados
-            download_opts['format'] = f'bestvideo[height>={height}]+bestaudio/best[height>={height}]/bestvideo[height<={height}]+bestaudio/best[height<={height}]/best'
-        else:
-            # "best" o cualquier otro valor usa mejor calidad disponible
-            download_opts['format'] = 'best'
-        
-        # Agregar postprocessor para recortar video si se especifican tiempos
-        if start_time is not None and end_time is not None and start_time < end_time:
-            # Calcular duración del recorte
-            trim_duration = end_time - start_time
-            
-            # Determinar qué tipo de postprocessor usar según el formato
-            if quality == "audio":
-                # Para audio, usar preprocessor_args en FFmpegExtractAudio
-                if postprocessors:
-                    # Modificar el postprocessor existente para incluir recorte
-                    postprocessors[0]['preprocessor_args'] = [
-                        '-ss', str(start_time),
-                        '-t', str(trim_duration)
-                    ]
-            # Para video, recortaremos después de la descarga usando ffmpeg directamente
+        yield span["attributes"]
+    except BaseException as e:
+        span["status"] = {"code": "ERROR", "message": str(e)}
+        raise
+    finally:
+        stack.pop()
+        if span["status"]["code"] == "OK" and span["attributes"].get("error"):
+            # Errores manejados dentro de la etapa también marcan el span
+            span["status"] = {"code": "ERROR", "message": str(span["attributes"]["error"])}
+        elif span["status"]["code"] == "OK" and span["attributes"].get("cancelled"):
+            # Una tarea cancelada no terminó bien aunque no haya excepción
+            span["status"] = {"code": "ERROR", "message": f"cancelled: {span['attributes']['cancelled']}"}
+        span["end_time_unix_nano"] = time.time_ns()
+        span["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        export_span(span)
+
+def download_video_task(task_id: str, url: str, quality: str, start_time: float = None, end_time: float = None):
+    """Función que ejecuta la descarga de video en un hilo separado.
+    Cada etapa queda registrada como un span (ver task_span)."""
+    with task_span(task_id, "download_task", url=url, quality=quality) as task_attrs:
+        try:
+            # Actualizar estado inicial
+            _task_thread.task_id = task_id
+            state = download_progress.setdefault(task_id, TaskState())
+            state.update(TaskStatus.STARTING, 0)
+        
+            # Directorio de trabajo de la tarea: se conserva si el proceso muere para poder reanudar
+            task_dir = task_scratch_dir(task_id)
+            os.makedirs(task_dir, exist_ok=True)
+        
+            with task_span(task_id, "clean_url") as span_attrs:
+                classified = classify_url(url)
+                clean_url = classified.canonical
+                is_youtube = classified.platform == "youtube"
+                span_attrs["clean_url"] = clean_url
+                span_attrs["platform"] = classified.platform or "generic"
+        
+            # Configurar opciones de descarga
+            download_opts = {
+                'outtmpl': os.path.join(task_dir, '%(title)s.%(ext)s'),
+                'quiet': True,
+                'no_warnings': True,
+                'socket_timeout': 30,
+                'retries': 3,  # Reintentar hasta 3 veces
+                'fragment_retries': 3,
+                'noprogress': True,  # No mostrar barra de progreso en consola
+                'suppress_warnings': True,  # Suprimir todas las advertencias
+                'continuedl': True,  # Continuar desde el .part si la tarea se reanuda tras un reinicio
+            }
         
-        # Asignar postprocessors si hay alguno
-        if postprocessors:
-            download_opts['postprocessors'] = postprocessors
+            # Determinar formato según calidad solicitada
+            postprocessors = []
+            audio_containers = parse_audio_quality(quality)
+            is_audio = audio_containers is not None
+            transcode_to = None  # Contenedor al que se recodifica después de descargar
+        
+            if is_audio:
+                # El pipeline definitivo (copia o recodificación) se decide al conocer los formatos
+                download_opts['format'] = 'bestaudio/best'
+            elif quality.startswith("height_"):
+                # Extraer altura (ej: "height_720" -> 720)
+                height = int(quality.replace("height_", ""))
+                # Para formatos específicos de altura, usar bestvideo+bestaudio para combinar
+                # Usar height>= para encontrar el mejor formato disponible desde esa altura hacia arriba
+                # Si no hay formato exacto, buscar el más cercano disponible
+                # Esto es especialmente importante para 4K donde video y audio están separados
+                download_opts['format'] = f'bestvideo[height>={height}]+bestaudio/best[height>={height}]/bestvideo[height<={height}]+bestaudio/best[height<={height}]/best'
+            else:
+                # "best" o cualquier otro valor usa mejor calidad disponible
+                download_opts['format'] = 'best'
         
-        if is_youtube:
-            # Usar múltiples clientes en orden de preferencia para evitar 403
-            # tv y android suelen funcionar mejor que web
-            download_opts['extractor_args'] = {
-                'youtube': {
-                    'player_client': ['android', 'tv', 'web'],  # android primero, luego tv, luego web
-                }
-            }
-            # Agregar headers adicionales para evitar bloqueos
-            download_opts['http_headers'] = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-            }
+            # Si se especifican tiempos, el recorte se hace después de la descarga con ffmpeg
         
-        # Callback para actualizar progreso
-        def progress_hook(d):
-            if d['status'] == 'downloading':
-                if 'total_bytes' in d:
-                    percent = (d['downloaded_bytes'] / d['total_bytes']) * 100
-                    download_progress[task_id] = {
-                        "status": "downloading",
-                        "percent": min(percent, 99),
-                        "message": f"Descargando... {d.get('_percent_str', '')}"
+            if is_youtube:
+                # Usar múltiples clientes en orden de preferencia para evitar 403
+                # tv y android suelen funcionar mejor que web
+                download_opts['extractor_args'] = {
+                    'youtube': {
+                        'player_client': ['android', 'tv', 'web'],  # android primero, luego tv, luego web
                     }
-                elif '_percent_str' in d:
-                    download_progress[task_id] = {
-                        "status": "downloading",
-                        "percent": 50,  # Estimación si no hay total_bytes
-                        "message": f"Descargando... {d['_percent_str']}"
-                    }
-            elif d['status'] == 'finished':
-                download_progress[task_id] = {
-                    "status": "processing",
-                    "percent": 95,
-                    "message": "Procesando archivo..."
+                }
+                # Agregar headers adicionales para evitar bloqueos
+                download_opts['http_headers'] = {
+                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                    'Accept-Language': 'en-us,en;q=0.5',
+                    'Accept-Encoding': 'gzip, deflate',
+                    'Connection': 'keep-alive',
                 }
         
-        download_opts['progress_hooks'] = [progress_hook]
-        
-        # Extraer información del video primero
-        info_opts = download_opts.copy()
-        info_opts['skip_download'] = True
-        
-        video_title = 'video'
-        video_uploader = ''
-        video_duration = 0
-        video_thumbnail = ''
-        duration_formatted = ""
-        
-        try:
-            with YoutubeDL(info_opts) as ydl:
-                info = ydl.extract_info(clean_url, download=False)
-                video_title = info.get('title', 'video')
-                video_uploader = info.get('uploader', '')
-                video_duration = info.get('duration', 0)
-                video_thumbnail = info.get('thumbnail', '')
-                
-                # Formatear duración
-                if video_duration:
-                    hours = video_duration // 3600
-                    minutes = (video_duration % 3600) // 60
-                    seconds = video_duration % 60
-                    if hours > 0:
-                        duration_formatted = f"{hours}:{minutes:02d}:{seconds:02d}"
-                    else:
-                        duration_formatted = f"{minutes}:{seconds:02d}"
-        except (ImportError, ModuleNotFoundError) as import_error:
-            # Manejar errores de importación de módulos de yt-dlp
-            error_msg = str(import_error)
-            if 'extractor' in error_msg.lower() or 'extractors' in error_msg.lower():
-                print(f"Error: Problema con módulos de yt-dlp. Reinstala yt-dlp: pip install --upgrade --force-reinstall yt-dlp[default]")
-                raise Exception("Error de configuración de yt-dlp. Por favor, reinstala yt-dlp ejecutando: pip install --upgrade --force-reinstall 'yt-dlp[default]'")
-            raise
-        except Exception as info_error:
-            # Si falla obtener info, continuar con valores por defecto
-            # pero registrar el error
-            print(f"Warning: No se pudo obtener información del video: {info_error}")
-        
-        # Realizar descarga con manejo de errores mejorado
-        download_success = False
-        last_error = None
+            # Callback para actualizar progreso (se llama muchas veces por segundo)
+            last_disk_check = 0.0
+            def progress_hook(d):
+                nonlocal last_disk_check
+                check_cancelled(state)  # Detiene yt-dlp desde dentro de la descarga
+                if d['status'] == 'downloading':
+                    # Detenerse antes de llenar el disco (otros procesos también escriben en él).
+                    # Tiene su propio intervalo: el filtro de progreso de abajo puede saltarse muchas llamadas
+                    now = time.monotonic()
+                    if now - last_disk_check >= DISK_CHECK_INTERVAL:
+                        last_disk_check = now
+                        if shutil.disk_usage(task_dir).free < disk_watermark(SCRATCH_DIR) // 4:
+                            raise Exception("Espacio en disco insuficiente para continuar la descarga. Intenta más tarde.")
+                    downloaded = d.get('downloaded_bytes') or 0
+                    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                    percent = min(downloaded / total * 100, 99) if total else 50  # Estimación si no hay total
+                    # Solo modificar el estado cuando el progreso avanza de forma apreciable
+                    # (sin total el porcentaje queda fijo: se mide en bytes)
+                    if state.status is TaskStatus.DOWNLOADING:
+                        if total and abs(percent - state.percent) < PROGRESS_MIN_STEP:
+                            return
+                        if not total and abs(downloaded - state.downloaded_bytes) < PROGRESS_MIN_BYTES:
+                            return
+                    state.downloaded_bytes = downloaded
+                    state.total_bytes = total
+                    state.speed = d.get('speed')
+                    state.update(TaskStatus.DOWNLOADING, percent)
+                elif d['status'] == 'finished':
+                    state.downloaded_bytes = d.get('downloaded_bytes') or d.get('total_bytes') or state.downloaded_bytes
+                    state.total_bytes = d.get('total_bytes') or state.total_bytes
+                    state.update(TaskStatus.PROCESSING, 95)
+        
+            download_opts['progress_hooks'] = [progress_hook]
+            # Los postprocesadores de yt-dlp (merge, extracción de audio) también se saltan al cancelar
+            download_opts['postprocessor_hooks'] = [lambda d: check_cancelled(state)]
+        
+            # Extraer información del video primero
+            info_opts = download_opts.copy()
+            info_opts['skip_download'] = True
+        
+            info = None
+            video_title = 'video'
+            video_uploader = ''
+            video_duration = 0
+            video_thumbnail = ''
+            duration_formatted = ""
         
-        # Intentar descarga con diferentes estrategias si falla
-        for attempt in range(3):  # Aumentar a 3 intentos para manejar mejor los 403
             try:
-                with YoutubeDL(download_opts) as ydl:
-                    ydl.download([clean_url])
-                download_success = True
-                break
+                with task_span(task_id, "extract_info") as span_attrs, YoutubeDL(info_opts) as ydl:
+                    info = ydl.extract_info(clean_url, download=False)
+                    video_title = info.get('title', 'video')
+                    video_uploader = info.get('uploader', '')
+                    video_duration = info.get('duration', 0)
+                    video_thumbnail = info.get('thumbnail', '')
+                    span_attrs["extractor"] = info.get('extractor_key') or info.get('extractor')
+                    span_attrs["duration"] = video_duration
+                    # Registrar el nombre base para reconocer los parciales de esta tarea
+                    journal_task(task_id, prefix=os.path.splitext(os.path.basename(ydl.prepare_filename(info)))[0])
+                
+                    # Formatear duración
+                    if video_duration:
+                        hours = video_duration // 3600
+                        minutes = (video_duration % 3600) // 60
+                        seconds = video_duration % 60
+                        if hours > 0:
+                            duration_formatted = f"{hours}:{minutes:02d}:{seconds:02d}"
+                        else:
+                            duration_formatted = f"{minutes}:{seconds:02d}"
             except (ImportError, ModuleNotFoundError) as import_error:
                 # Manejar errores de importación de módulos de yt-dlp
                 error_msg = str(import_error)
                 if 'extractor' in error_msg.lower() or 'extractors' in error_msg.lower():
+                    print(f"Error: Problema con módulos de yt-dlp. Reinstala yt-dlp: pip install --upgrade --force-reinstall yt-dlp[default]")
                     raise Exception("Error de configuración de yt-dlp. Por favor, reinstala yt-dlp ejecutando: pip install --upgrade --force-reinstall 'yt-dlp[default]'")
                 raise
-            except Exception as download_error:
-                last_error = download_error
-                error_str = str(download_error).lower()
+            except Exception as info_error:
+                # Si falla obtener info, continuar con valores por defecto
+                # pero registrar el error
+                print(f"Warning: No se pudo obtener información del video: {info_error}")
+        
+            if is_audio:
+                # Preferir copiar el stream de audio si su códec ya está en un contenedor aceptado
+                with task_span(task_id, "audio_plan", accepted=",".join(audio_containers)) as span_attrs:
+                    choice = choose_audio_format(info.get('formats') if info else None, audio_containers)
+                    if choice:
+                        format_id, container = choice
+                        download_opts['format'] = f"{format_id}/bestaudio/best"
+                        postprocessors.append({
+                            'key': 'FFmpegExtractAudio',
+                            'preferredcodec': container,  # Mismo códec: yt-dlp solo cambia de contenedor
+                        })
+                        span_attrs.update(mode="copy", format_id=format_id, container=container)
+                    else:
+                        transcode_to = audio_containers[0]
+                        span_attrs.update(mode="transcode", container=transcode_to)
+        
+            # Asignar postprocessors si hay alguno
+            if postprocessors:
+                download_opts['postprocessors'] = postprocessors
+        
+            # Realizar descarga con manejo de errores mejorado
+            download_success = False
+            last_error = None
+        
+            # Intentar descarga con diferentes estrategias si falla
+            for attempt in range(3):  # Aumentar a 3 intentos para manejar mejor los 403
+                check_cancelled(state)
+                try:
+                    player_client = download_opts.get('extractor_args', {}).get('youtube', {}).get('player_client')
+                    state.downloaded_bytes, state.total_bytes = 0, None
+                    with task_span(task_id, "download_attempt",
+                                   attempt=attempt + 1,
+                                   player_client=",".join(player_client) if player_client else None,
+                                   format=download_opts.get('format')) as span_attrs:
+                        try:
+                            with YoutubeDL(download_opts) as ydl:
+                                ydl.download([clean_url])
+                        finally:
+                            span_attrs.update(downloaded_bytes=state.downloaded_bytes, total_bytes=state.total_bytes)
+                    download_success = True
+                    break
+                except (ImportError, ModuleNotFoundError) as import_error:
+                    # Manejar errores de importación de módulos de yt-dlp
+                    error_msg = str(import_error)
+                    if 'extractor' in error_msg.lower() or 'extractors' in error_msg.lower():
+                        raise Exception("Error de configuración de yt-dlp. Por favor, reinstala yt-dlp ejecutando: pip install --upgrade --force-reinstall 'yt-dlp[default]'")
+                    raise
+                except Exception as download_error:
+                    last_error = download_error
+                    error_str = str(download_error).lower()
                 
-                # Si es error 403, intentar con diferentes estrategias
-                if ("403" in error_str or "forbidden" in error_str) and is_youtube:
-                    if attempt == 0:
-                        # Primer intento: cambiar a cliente web
-                        download_opts['extractor_args'] = {
-                            'youtube': {
-                                'player_client': ['web'],
+                    # Si es error 403, intentar con diferentes estrategias
+                    if ("403" in error_str or "forbidden" in error_str) and is_youtube:
+                        if attempt == 0:
+                            # Primer intento: cambiar a cliente web
+                            download_opts['extractor_args'] = {
+                                'youtube': {
+                                    'player_client': ['web'],
+                                }
                             }
-                        }
-                        download_progress[task_id] = {
-                            "status": "downloading",
-                            "percent": 10,
-                            "message": "Reintentando con cliente web..."
-                        }
-                        continue
-                    elif attempt == 1:
-                        # Segundo intento: usar formato más flexible para evitar restricciones
-                        if quality.startswith("height_"):
-                            height = int(quality.replace("height_", ""))
-                            # Intentar con formato más permisivo que combine mejor
-                            download_opts['format'] = f'bestvideo[height<={height}]+bestaudio/best[height<={height}]/best'
-                        download_opts['extractor_args'] = {
-                            'youtube': {
-                                'player_client': ['android', 'tv'],
+                            state.update(TaskStatus.DOWNLOADING, 10, "Reintentando con cliente web...")
+                            continue
+                        elif attempt == 1:
+                            # Segundo intento: usar formato más flexible para evitar restricciones
+                            if quality.startswith("height_"):
+                                height = int(quality.replace("height_", ""))
+                                # Intentar con formato más permisivo que combine mejor
+                                download_opts['format'] = f'bestvideo[height<={height}]+bestaudio/best[height<={height}]/best'
+                            download_opts['extractor_args'] = {
+                                'youtube': {
+                                    'player_client': ['android', 'tv'],
+                                }
                             }
-                        }
-                        download_progress[task_id] = {
-                            "status": "downloading",
-                            "percent": 20,
-                            "message": "Reintentando con formato alternativo..."
-                        }
-                        continue
-                    else:
-                        # Si todos los intentos fallan, lanzar error específico para 4K
-                        if quality.startswith("height_2160") or (quality.startswith("height_") and int(quality.replace("height_", "")) >= 2160):
-                            raise Exception("Error 403: YouTube está bloqueando la descarga en 4K. Esto puede deberse a restricciones de la plataforma. Intenta descargar en una calidad menor (1440p o 1080p) o más tarde.")
+                            state.update(TaskStatus.DOWNLOADING, 20, "Reintentando con formato alternativo...")
+                            continue
                         else:
-                            raise Exception("Error 403: Acceso denegado. El servidor bloqueó la descarga. Esto puede deberse a restricciones de la plataforma. Intenta más tarde o con otro video.")
+                            # Si todos los intentos fallan, lanzar error específico para 4K
+                            if quality.startswith("height_2160") or (quality.startswith("height_") and int(quality.replace("height_", "")) >= 2160):
+                                raise Exception("Error 403: YouTube está bloqueando la descarga en 4K. Esto puede deberse a restricciones de la plataforma. Intenta descargar en una calidad menor (1440p o 1080p) o más tarde.")
+                            else:
+                                raise Exception("Error 403: Acceso denegado. El servidor bloqueó la descarga. Esto puede deberse a restricciones de la plataforma. Intenta más tarde o con otro video.")
+                    else:
+                        # Si no es 403 o ya intentamos todo, lanzar el error
+                        raise download_error
+        
+            if not download_success:
+                raise last_error if last_error else Exception("Error desconocido al descargar")
+        
+            # Buscar el archivo descargado (el directorio de trabajo es solo de esta tarea)
+            with task_span(task_id, "find_file") as span_attrs:
+                downloaded_files = [f for f in os.listdir(task_dir) 
+                                   if os.path.isfile(os.path.join(task_dir, f)) 
+                                   and not f.startswith('.')
+                                   and not PARTIAL_FILE_RE.search(f)]
+        
+                # Si quedaron varios (p. ej. formatos sueltos), el más reciente es el resultado final
+                if downloaded_files:
+                    downloaded_files.sort(key=lambda f: os.path.getmtime(os.path.join(task_dir, f)), reverse=True)
+                    filename = downloaded_files[0]
                 else:
-                    # Si no es 403 o ya intentamos todo, lanzar el error
-                    raise download_error
-        
-        if not download_success:
-            raise last_error if last_error else Exception("Error desconocido al descargar")
-        
-        # Buscar el archivo descargado
-        downloaded_files = [f for f in os.listdir(DOWNLOAD_DIR) 
-                           if os.path.isfile(os.path.join(DOWNLOAD_DIR, f)) 
-                           and not f.startswith('.')]
-        
-        # Encontrar el archivo más reciente (probablemente el que acabamos de descargar)
-        if downloaded_files:
-            downloaded_files.sort(key=lambda f: os.path.getmtime(os.path.join(DOWNLOAD_DIR, f)), reverse=True)
-            filename = downloaded_files[0]
-        else:
-            raise Exception("No se encontró el archivo descargado")
-        
-        # Recortar video si se especificaron tiempos (solo para video, no audio)
-        if start_time is not None and end_time is not None and start_time < end_time and quality != "audio":
-            temp_path = None
-            try:
-                file_path = os.path.join(DOWNLOAD_DIR, filename)
-                trim_duration = end_time - start_time
+                    raise Exception("No se encontró el archivo descargado")
+                span_attrs["filename"] = filename
+                span_attrs["file_bytes"] = os.path.getsize(os.path.join(task_dir, filename))
+        
+            # Recodificar audio cuando no se pudo copiar el stream (incluye el recorte)
+            if transcode_to:
+                file_path = os.path.join(task_dir, filename)
+                state.update(TaskStatus.PROCESSING, 90, "Esperando turno para convertir audio...")
+                # Esperar turno sin dejar de atender una cancelación
+                while not transcode_slots.acquire(timeout=1):
+                    check_cancelled(state)
+                try:
+                    check_cancelled(state)
+                    state.update(TaskStatus.PROCESSING, 90, f"Convirtiendo audio a {transcode_to.upper()}...")
+                    with task_span(task_id, "audio_transcode", container=transcode_to,
+                                   input_bytes=os.path.getsize(file_path)) as span_attrs:
+                        file_path = transcode_audio(file_path, transcode_to, start_time, end_time, task_id)
+                        span_attrs["output_bytes"] = os.path.getsize(file_path)
+                finally:
+                    transcode_slots.release()
+                filename = os.path.basename(file_path)
+        
+            # Recortar si se especificaron tiempos (el audio recodificado ya viene recortado)
+            if start_time is not None and end_time is not None and start_time < end_time and not transcode_to:
+                temp_path = None
+                try:
+                    file_path = os.path.join(task_dir, filename)
+                    trim_duration = end_time - start_time
                 
-                # Crear nombre de archivo temporal para el recorte
-                base_name, ext = os.path.splitext(filename)
-                temp_filename = f"{base_name}_trimmed{ext}"
-                temp_path = os.path.join(DOWNLOAD_DIR, temp_filename)
+                    # Crear nombre de archivo temporal para el recorte
+                    base_name, ext = os.path.splitext(filename)
+                    temp_filename = f"{base_name}_trimmed{ext}"
+                    temp_path = os.path.join(task_dir, temp_filename)
                 
-                # Actualizar progreso
-                download_progress[task_id] = {
-                    "status": "processing",
-                    "percent": 90,
-                    "message": "Recortando video..."
-                }
+                    # Actualizar progreso
+                    state.update(TaskStatus.PROCESSING, 90, "Recortando audio..." if is_audio else "Recortando video...")
                 
-                # Ejecutar ffmpeg para recortar el video
-                # Usar -ss para inicio, -t para duración, y -c copy para evitar re-encoding
-                ffmpeg_cmd = [
-                    'ffmpeg',
-                    '-i', file_path,
-                    '-ss', str(start_time),
-                    '-t', str(trim_duration),
-                    '-c', 'copy',  # Copiar streams sin re-encoding
-                    '-avoid_negative_ts', 'make_zero',  # Evitar timestamps negativos
-                    '-y',  # Sobrescribir archivo de salida si existe
-                    temp_path
-                ]
+                    # Ejecutar ffmpeg para recortar el video
+                    # Usar -ss para inicio, -t para duración, y -c copy para evitar re-encoding
+                    ffmpeg_cmd = [
+                        'ffmpeg',
+                        '-i', file_path,
+                        '-ss', str(start_time),
+                        '-t', str(trim_duration),
+                        '-c', 'copy',  # Copiar streams sin re-encoding
+                        '-avoid_negative_ts', 'make_zero',  # Evitar timestamps negativos
+                        '-y',  # Sobrescribir archivo de salida si existe
+                        temp_path
+                    ]
                 
-                result = subprocess.run(
-                    ffmpeg_cmd,
-                    capture_output=True,
-                    text=True,
-                    timeout=300  # Timeout de 5 minutos
-                )
+                    with task_span(task_id, "ffmpeg_trim", start_time=start_time, end_time=end_time,
+                                   input_bytes=os.path.getsize(file_path)) as span_attrs:
+                        result = run_task_process(task_id, ffmpeg_cmd, timeout=300)  # Timeout de 5 minutos
+                        span_attrs["returncode"] = result.returncode
+                        if result.returncode == 0 and os.path.exists(temp_path):
+                            span_attrs["output_bytes"] = os.path.getsize(temp_path)
                 
-                if result.returncode == 0:
-                    # Reemplazar el archivo original con el recortado
-                    os.replace(temp_path, file_path)
-                    download_progress[task_id] = {
-                        "status": "processing",
-                        "percent": 95,
-                        "message": "Recorte completado"
-                    }
-                else:
-                    # Si falla el recorte, mantener el archivo original
+                    if result.returncode == 0:
+                        # Reemplazar el archivo original con el recortado
+                        os.replace(temp_path, file_path)
+                        state.update(TaskStatus.PROCESSING, 95, "Recorte completado")
+                    else:
+                        # Si falla el recorte, mantener el archivo original
+                        if temp_path and os.path.exists(temp_path):
+                            os.remove(temp_path)
+                        print(f"Warning: No se pudo recortar el video: {result.stderr}")
+                        # Continuar con el archivo original
+                except subprocess.TimeoutExpired:
+                    # Si el timeout expira, mantener el archivo original
                     if temp_path and os.path.exists(temp_path):
                         os.remove(temp_path)
-                    print(f"Warning: No se pudo recortar el video: {result.stderr}")
-                    # Continuar con el archivo original
-            except subprocess.TimeoutExpired:
-                # Si el timeout expira, mantener el archivo original
-                if temp_path and os.path.exists(temp_path):
-                    os.remove(temp_path)
-                print("Warning: Timeout al recortar el video, usando archivo completo")
-            except Exception as trim_error:
-                # Si hay cualquier error, mantener el archivo original
-                if temp_path and os.path.exists(temp_path):
-                    os.remove(temp_path)
-                print(f"Warning: Error al recortar el video: {trim_error}")
+                    print("Warning: Timeout al recortar el video, usando archivo completo")
+                except Exception as trim_error:
+                    # Si hay cualquier error, mantener el archivo original
+                    if temp_path and os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    print(f"Warning: Error al recortar el video: {trim_error}")
         
-        # Actualizar estado final
-        download_progress[task_id] = {
-            "status": "completed",
-            "percent": 100,
-            "message": "Descarga completada"
-        }
+            # Un recorte interrumpido por cancelación no debe terminar como completado
+            check_cancelled(state)
         
-        download_results[task_id] = {
-            "filename": filename,
-            "video_info": {
-                "title": video_title,
-                "uploader": video_uploader,
-                "duration_formatted": duration_formatted,
-                "thumbnail": video_thumbnail
-            },
-            "platform": detect_platform(url)
-        }
+            # Publicar el archivo terminado en DOWNLOAD_DIR (nunca aparece a medio escribir)
+            filename = publish_download(os.path.join(task_dir, filename))
+            forget_completed_download(filename)
         
-    except Exception as e:
-        error_str = str(e).lower()
-        error_message = str(e)
+            # Actualizar estado final
+            state.update(TaskStatus.COMPLETED, 100)
         
-        # Manejo específico de errores comunes
-        if "403" in error_str or "forbidden" in error_str:
-            error_message = "Error 403: Acceso denegado. El servidor bloqueó la descarga. Esto puede deberse a restricciones de la plataforma. Intenta más tarde o con otro video."
-        elif "timeout" in error_str or "timed out" in error_str:
-            error_message = "Timeout al descargar. El servidor no respondió a tiempo. Intenta nuevamente."
-        elif "private video" in error_str or "sign in" in error_str or "private" in error_str:
-            error_message = "Este video es privado o requiere autenticación."
-        elif "video unavailable" in error_str or "unavailable" in error_str or "does not exist" in error_str:
-            error_message = "Este video no está disponible o ha sido eliminado."
-        elif "age-restricted" in error_str or "age restricted" in error_str:
-            error_message = "Este video tiene restricción de edad."
-        elif "region" in error_str or "not available in your country" in error_str:
-            error_message = "Este video no está disponible en tu región."
-        elif "http error" in error_str:
-            # Extraer código de error HTTP si está disponible
-            http_code_match = re.search(r'http error (\d+)', error_str)
-            if http_code_match:
-                http_code = http_code_match.group(1)
-                if http_code == "403":
-                    error_message = "Error 403: Acceso denegado. La plataforma bloqueó la descarga. Intenta más tarde."
-                elif http_code == "429":
-                    error_message = "Error 429: Demasiadas solicitudes. Espera unos minutos antes de intentar nuevamente."
+            is_trimmed = start_time is not None and end_time is not None and start_time < end_time
+            if not is_audio and not is_trimmed:
+                remember_completed_download(url, filename)
+        
+            download_results[task_id] = {
+                "filename": filename,
+                "video_info": {
+                    "title": video_title,
+                    "uploader": video_uploader,
+                    "duration_formatted": duration_formatted,
+                    "thumbnail": proxied_thumbnail_url(video_thumbnail)
+                },
+                "platform": detect_platform(url),
+                "preview": None if is_audio else preview_strip_url(filename)
+            }
+            task_attrs["filename"] = filename
+            task_attrs["file_bytes"] = os.path.getsize(os.path.join(DOWNLOAD_DIR, filename))
+        
+        except Exception as e:
+            if state.cancel_reason:
+                # Cancelada (por el usuario o por inactividad): no es un error de descarga
+                removed = remove_task_scratch(task_id)
+                message = CANCEL_MESSAGES[state.cancel_reason]
+                state.update(TaskStatus.CANCELLED, state.percent, message)
+                download_results[task_id] = {"error": message, "cancelled": True}
+                task_attrs.update(cancelled=state.cancel_reason, partials_removed=removed)
+                return
+        
+            error_str = str(e).lower()
+            error_message = str(e)
+        
+            # Manejo específico de errores comunes
+            if "403" in error_str or "forbidden" in error_str:
+                error_message = "Error 403: Acceso denegado. El servidor bloqueó la descarga. Esto puede deberse a restricciones de la plataforma. Intenta más tarde o con otro video."
+            elif "timeout" in error_str or "timed out" in error_str:
+                error_message = "Timeout al descargar. El servidor no respondió a tiempo. Intenta nuevamente."
+            elif "private video" in error_str or "sign in" in error_str or "private" in error_str:
+                error_message = "Este video es privado o requiere autenticación."
+            elif "video unavailable" in error_str or "unavailable" in error_str or "does not exist" in error_str:
+                error_message = "Este video no está disponible o ha sido eliminado."
+            elif "age-restricted" in error_str or "age restricted" in error_str:
+                error_message = "Este video tiene restricción de edad."
+            elif "region" in error_str or "not available in your country" in error_str:
+                error_message = "Este video no está disponible en tu región."
+            elif "http error" in error_str:
+                # Extraer código de error HTTP si está disponible
+                http_code_match = re.search(r'http error (\d+)', error_str)
+                if http_code_match:
+                    http_code = http_code_match.group(1)
+                    if http_code == "403":
+                        error_message = "Error 403: Acceso denegado. La plataforma bloqueó la descarga. Intenta más tarde."
+                    elif http_code == "429":
+                        error_message = "Error 429: Demasiadas solicitudes. Espera unos minutos antes de intentar nuevamente."
+                    else:
+                        error_message = f"Error HTTP {http_code}: No se pudo descargar el video."
                 else:
-                    error_message = f"Error HTTP {http_code}: No se pudo descargar el video."
-            else:
-                error_message = "Error de conexión HTTP. Verifica tu conexión a internet e intenta nuevamente."
+                    error_message = "Error de conexión HTTP. Verifica tu conexión a internet e intenta nuevamente."
         
-        # Log del error completo para debugging
-        print(f"Error en download_video_task para {url}:")
-        print(traceback.format_exc())
+            # Log del error completo para debugging
+            print(f"Error en download_video_task para {url}:")
+            print(traceback.format_exc())
         
-        download_progress[task_id] = {
-            "status": "error",
-            "percent": 0,
-            "message": error_message
-        }
+            state.update(TaskStatus.ERROR, 0, error_message)
         
-        download_results[task_id] = {
-            "error": error_message
-        }
+            download_results[task_id] = {
+                "error": error_message
+            }
+            task_attrs["error"] = error_message
+        finally:
+            # La tarea terminó en este proceso: ya no hay nada que reanudar
+            _task_thread.task_id = None
+            task_processes.pop(task_id, None)
+            journal_remove(task_id)
+            remove_task_scratch(task_id)
+
+def format_size(fmt: dict, duration: float):
+    """Tamaño en bytes de un formato: el declarado, el aproximado o bitrate x duración"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size or None
+
+def estimate_format_sizes(formats: list, duration: float) -> dict:
+    """Tamaño estimado de cada valor de quality (best, audio, height_<h>) a partir de los formatos"""
+    sizes = {}
+    audio_sizes = [
+        format_size(f, duration) for f in formats
+        if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+    ]
+    best_audio = max((size for size in audio_sizes if size), default=0)
+    for fmt in formats:
+        height = fmt.get('height')
+        size = format_size(fmt, duration)
+        if not height or not size or fmt.get('vcodec') in (None, 'none'):
+            continue
+        if fmt.get('acodec') in (None, 'none'):
+            size += best_audio  # Video sin audio: se combina con el mejor audio
+        key = f"height_{int(height)}"
+        sizes[key] = max(sizes.get(key, 0), size)
+    if best_audio:
+        sizes["audio"] = sizes["audio_original"] = best_audio
+    video_sizes = [size for key, size in sizes.items() if key.startswith("height_")]
+    if video_sizes:
+        sizes["best"] = max(video_sizes)
+    return sizes
+
+def remember_format_estimate(url: str, info: dict, formats: list):
+    """Guarda los tamaños por calidad de una URL ya sondeada para estimar el costo al descargar"""
+    duration = (info or {}).get('duration') or 0
+    estimate = {"duration": duration, "sizes": estimate_format_sizes(formats or [], duration)}
+    with format_estimates_lock:
+        format_estimates[canonical_url(url)] = estimate
+        format_estimates.move_to_end(canonical_url(url))
+        while len(format_estimates) > FORMAT_ESTIMATES_SIZE:
+            format_estimates.popitem(last=False)
+
+def estimate_task_cost(url: str, quality: str) -> float:
+    """Bytes que se espera descargar: tamaño de los formatos si se sondearon, si no duración x bitrate"""
+    is_audio = parse_audio_quality(quality) is not None
+    with format_estimates_lock:
+        estimate = format_estimates.get(canonical_url(url))
+    duration = None
+    if estimate:
+        sizes = estimate["sizes"]
+        size = sizes.get(quality)
+        if not size and quality.startswith("height_"):
+            # Igual que el selector de formato: la menor altura >= a la pedida, o la mayor por debajo
+            height = int(quality.replace("height_", ""))
+            heights = sorted(int(key[7:]) for key in sizes if key.startswith("height_"))
+            above = [h for h in heights if h >= height]
+            if heights:
+                size = sizes[f"height_{above[0] if above else heights[-1]}"]
+        size = size or sizes.get("audio" if is_audio else "best")
+        if size:
+            return float(size)
+        duration = estimate["duration"]
+    if not duration:
+        return float(DEFAULT_TASK_COST)
+    if is_audio:
+        return duration * QUALITY_BYTES_PER_SECOND["audio"]
+    height = int(quality.replace("height_", "")) if quality.startswith("height_") else 1080
+    # Bitrate de la altura conocida más cercana por arriba (o la mayor si excede la tabla)
+    heights = sorted(h for h in QUALITY_BYTES_PER_SECOND if h != "audio")
+    bucket = next((h for h in heights if h >= height), heights[-1])
+    return duration * QUALITY_BYTES_PER_SECOND[bucket]
+
+def request_client_id() -> str:
+    """Identidad del cliente para el reparto justo: API key configurada o, si no, la IP"""
+    api_key = request.headers.get("X-API-Key")
+    if api_key and api_key in CLIENT_WEIGHTS:
+        return f"key:{api_key}"
+    return f"ip:{request.remote_addr}"
+
+def client_weight(client: str) -> float:
+    if client.startswith("key:"):
+        return max(CLIENT_WEIGHTS.get(client[4:], 1.0), 0.01)
+    return 1.0
+
+def disk_needs(cost: float) -> dict:
+    """Bytes a reservar por volumen para una tarea con el costo estimado dado"""
+    scratch = cost * DISK_RESERVE_FACTOR
+    if SCRATCH_SAME_VOLUME:
+        return {DOWNLOAD_DIR: scratch}  # Publicar es un rename: el final no ocupa espacio extra
+    return {SCRATCH_DIR: scratch, DOWNLOAD_DIR: cost}
+
+def disk_watermark(directory: str) -> int:
+    return DISK_MIN_FREE if directory == DOWNLOAD_DIR or SCRATCH_SAME_VOLUME else SCRATCH_MIN_FREE
+
+def disk_available(directory: str) -> float:
+    """Bytes libres por encima de la marca de agua, descontando lo ya reservado.
+    Lo que una tarea ya escribió en SCRATCH_DIR dejó de estar libre: de su reserva en ese
+    volumen solo se descuenta lo que le falta."""
+    holds_scratch = directory == SCRATCH_DIR or SCRATCH_SAME_VOLUME
+    reserved = 0
+    for task_id, needs in list(disk_reservations.items()):
+        state = download_progress.get(task_id)
+        written = (state.downloaded_bytes or 0) if holds_scratch and state is not None else 0
+        reserved += max(needs.get(directory, 0) - written, 0)
+    return shutil.disk_usage(directory).free - reserved - disk_watermark(directory)
+
+def disk_shortfall(needs: dict):
+    """Bytes que faltan para una tarea aunque terminen todas las demás, o None si cabe"""
+    missing = max(need - (shutil.disk_usage(d).free - disk_watermark(d)) for d, need in needs.items())
+    return missing if missing > 0 else None
+
+def place_unique(src_path: str, filename: str) -> str:
+    """Mueve src_path a DOWNLOAD_DIR con el primer nombre libre (video.mp4, video_1.mp4, ...).
+    os.link falla si el destino existe, así que dos tareas con el mismo título nunca se pisan.
+    Sin enlaces duros se reserva el nombre con O_EXCL y se reemplaza esa reserva vacía.
+    En modo distribuido el nombre también se reserva en la tabla artifacts: otro nodo puede
+    haber publicado uno igual en su propio DOWNLOAD_DIR."""
+    base, ext = os.path.splitext(filename)
+    n = 0
+    while True:
+        candidate = f"{base}_{n}{ext}" if n else filename
+        n += 1
+        if CLUSTER_DB and not cluster_reserve_name(candidate):
+            continue
+        dst_path = os.path.join(DOWNLOAD_DIR, candidate)
+        try:
+            try:
+                os.link(src_path, dst_path)
+                os.remove(src_path)
+            except OSError as e:
+                if e.errno not in LINK_UNSUPPORTED_ERRNOS:
+                    raise
+                os.close(os.open(dst_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                try:
+                    os.replace(src_path, dst_path)
+                except OSError:
+                    os.remove(dst_path)
+                    raise
+        except BaseException as e:
+            if CLUSTER_DB:
+                cluster_release_name(candidate)
+            if isinstance(e, FileExistsError):
+                continue
+            raise
+        if CLUSTER_DB:
+            cluster_publish_name(candidate, os.path.getsize(dst_path))
+        return candidate
+
+def publish_download(src_path: str) -> str:
+    """Mueve un archivo terminado del directorio de trabajo a DOWNLOAD_DIR sin que nunca
+    se vea a medio escribir ni reemplace otro archivo. Devuelve el nombre final."""
+    filename = os.path.basename(src_path)
+    try:
+        return place_unique(src_path, filename)  # Mismo volumen: sin copiar
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # Otro volumen (p. ej. tmpfs): copiar con nombre oculto y moverlo en el destino.
+    # Si el proceso muere a mitad, collect_orphan_partials borra la copia oculta
+    tmp_path = os.path.join(DOWNLOAD_DIR, f".{filename}.{uuid.uuid4().hex}.tmp")
+    try:
+        shutil.copyfile(src_path, tmp_path)
+        filename = place_unique(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    os.remove(src_path)
+    return filename
+
+def task_scratch_dir(task_id: str) -> str:
+    return os.path.join(SCRATCH_DIR, task_id)
+
+def remove_task_scratch(task_id: str) -> int:
+    """Elimina el directorio de trabajo de una tarea (parciales, fragmentos, temporales)"""
+    task_dir = task_scratch_dir(task_id)
+    if not os.path.isdir(task_dir):
+        return 0
+    count = len(os.listdir(task_dir))
+    shutil.rmtree(task_dir, ignore_errors=True)
+    return count
+
+class QueuedDownload:
+    """Descarga en espera de un worker"""
+    __slots__ = ("task_id", "client", "cost", "needs", "enqueued", "args")
+
+    def __init__(self, task_id: str, client: str, cost: float, args: tuple):
+        self.task_id = task_id
+        self.client = client
+        self.cost = cost
+        self.needs = disk_needs(cost)  # Espacio que se reserva al empezar
+        self.enqueued = time.monotonic()
+        self.args = args
+
+    @property
+    def small(self) -> bool:
+        return self.cost <= SMALL_JOB_BYTES
+
+    def effective_cost(self, now: float) -> float:
+        # Envejecimiento: una tarea grande que espera mucho termina pasando delante de las pequeñas nuevas
+        return self.cost * 0.5 ** ((now - self.enqueued) / AGING_HALF_LIFE)
+
+class DownloadScheduler:
+    """Reparte DOWNLOAD_WORKERS hilos entre las descargas pendientes.
+
+    - Entre clientes, reparto justo ponderado: se atiende al cliente con menos servicio
+      acumulado (bytes estimados / peso). Un cliente que vuelve tras estar inactivo parte
+      del reloj actual y no acumula crédito.
+    - Dentro de la cola de un cliente, primero la tarea más corta, con envejecimiento.
+    - Con más de un worker, uno queda reservado para tareas pequeñas: un MP3 corto no espera
+      detrás de varias descargas 4K.
+    - Una tarea solo empieza si su espacio estimado cabe por encima de DISK_MIN_FREE; si no,
+      espera en cola sin bloquear a las que sí caben."""
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.large_limit = self.workers - 1 if self.workers > 1 else 1
+        self.cond = threading.Condition()
+        self.queues = {}  # cliente -> [QueuedDownload]
+        self.service = {}  # cliente -> servicio acumulado normalizado por peso
+        self.clock = 0.0  # Servicio del último cliente atendido
+        self.running = 0
+        self.running_large = 0
+        self.started = False
+
+    def submit(self, job: QueuedDownload):
+        with self.cond:
+            if not self.started:
+                for i in range(self.workers):
+                    threading.Thread(target=self._worker, name=f"download-{i}", daemon=True).start()
+                self.started = True
+            if not self.queues.get(job.client):
+                self.service[job.client] = max(self.service.get(job.client, 0.0), self.clock)
+            self.queues.setdefault(job.client, []).append(job)
+            self.cond.notify()
+
+    def remove(self, task_id: str) -> bool:
+        """Quita una tarea que todavía no empezó; False si no estaba en cola"""
+        with self.cond:
+            for client, jobs in self.queues.items():
+                for job in jobs:
+                    if job.task_id == task_id:
+                        jobs.remove(job)
+                        if not jobs:
+                            del self.queues[client]
+                        return True
+        return False
+
+    def queued(self) -> int:
+        with self.cond:
+            return sum(len(jobs) for jobs in self.queues.values())
+
+    def capacity(self):
+        """(workers libres sin nada en cola, si se admite una tarea grande)"""
+        with self.cond:
+            if self.queues:
+                return 0, False
+            return self.workers - self.running, self.running_large < self.large_limit
+
+    def _next_job(self):
+        """Elige la siguiente tarea (se llama con el lock tomado)"""
+        if not self.queues:
+            return None
+        now = time.monotonic()
+        allow_large = self.running_large < self.large_limit
+        available = {d: disk_available(d) for d in {DOWNLOAD_DIR, SCRATCH_DIR}}
+        best = None
+        for client, jobs in self.queues.items():
+            eligible = []
+            for job in jobs:
+                if not (allow_large or job.small):
+                    continue
+                if any(need > available[d] for d, need in job.needs.items()):
+                    state = download_progress.get(job.task_id)
+                    if state is not None:
+                        state.note = "Esperando espacio en disco..."
+                    continue
+                eligible.append(job)
+            if not eligible:
+                continue
+            if best is None or self.service[client] < self.service[best[0]]:
+                best = (client, min(eligible, key=lambda job: job.effective_cost(now)))
+        if best is None:
+            return None
+        client, job = best
+        jobs = self.queues[client]
+        jobs.remove(job)
+        self.clock = self.service[client]
+        self.service[client] += job.cost / client_weight(client)
+        if not jobs:
+            del self.queues[client]
+            if self.service[client] <= self.clock:
+                del self.service[client]  # Sin deuda pendiente: se recalcula al volver
+        self.running += 1
+        if not job.small:
+            self.running_large += 1
+        disk_reservations[job.task_id] = job.needs
+        return job
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                job = self._next_job()
+                while job is None:
+                    # Con timeout: el espacio en disco también se libera fuera del planificador
+                    self.cond.wait(timeout=5)
+                    job = self._next_job()
+            try:
+                download_video_task(job.task_id, *job.args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    if not job.small:
+                        self.running_large -= 1
+                    disk_reservations.pop(job.task_id, None)
+                    self.cond.notify_all()
+                cluster_wakeup.set()  # Un worker libre puede tomar otra tarea de la cola compartida
+
+download_scheduler = DownloadScheduler(DOWNLOAD_WORKERS)
+
+def schedule_download(task_id: str, url: str, quality: str, start_time: float = None, end_time: float = None,
+                      client: str = "local", cost: float = None):
+    """Encola download_video_task en el planificador local"""
+    global _reaper_started
+    if TASK_IDLE_TIMEOUT > 0 and not _reaper_started:
+        with reaper_lock:
+            if not _reaper_started:
+                threading.Thread(target=reap_idle_tasks, name="task-reaper", daemon=True).start()
+                _reaper_started = True
+    if cost is None:
+        cost = estimate_task_cost(url, quality)
+    download_scheduler.submit(QueuedDownload(task_id, client, cost, (url, quality, start_time, end_time)))
+
+def cancel_task(task_id: str, reason: str) -> bool:
+    """Marca la tarea como cancelada y mata su ffmpeg si hay uno en curso (propio o de un
+    postprocesador de yt-dlp). yt-dlp se detiene en el siguiente progress_hook; la tarea limpia sus archivos parciales."""
+    state = download_progress.get(task_id)
+    if state is None or state.status in FINAL_STATUSES:
+        return False
+    state.cancel_reason = state.cancel_reason or reason
+    if download_scheduler.remove(task_id):
+        # Todavía en cola: no hay hilo que la termine
+        message = CANCEL_MESSAGES[reason]
+        state.update(TaskStatus.CANCELLED, 0, message)
+        download_results[task_id] = {"error": message, "cancelled": True}
+        journal_remove(task_id)
+        return True
+    process = task_processes.get(task_id)
+    if process is not None and process.poll() is None:
+        process.kill()
+    return True
+
+def reap_idle_tasks():
+    """Cancela las tareas cuyo cliente no consulta el progreso desde hace TASK_IDLE_TIMEOUT segundos"""
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        now = time.monotonic()
+        for task_id, state in list(download_progress.items()):
+            if state.status in FINAL_STATUSES or state.cancel_reason:
+                continue
+            if now - state.last_seen > TASK_IDLE_TIMEOUT:
+                print(f"Cancelando la tarea {task_id}: sin consultas de progreso en {TASK_IDLE_TIMEOUT:.0f}s")
+                cancel_task(task_id, "idle")
+
+def cluster_connection() -> sqlite3.Connection:
+    """Conexión del hilo actual a la base compartida (se crea el esquema la primera vez)"""
+    conn = getattr(_cluster_local, "conn", None)
+    if conn is None:
+        # Sin WAL: su memoria compartida no funciona sobre sistemas de archivos de red
+        conn = sqlite3.connect(CLUSTER_DB, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                task_id TEXT PRIMARY KEY, url TEXT NOT NULL, quality TEXT NOT NULL,
+                start_time REAL, end_time REAL, client TEXT NOT NULL, cost REAL NOT NULL,
+                created REAL NOT NULL, node_id TEXT, status TEXT NOT NULL, progress TEXT NOT NULL,
+                result TEXT, last_seen REAL NOT NULL, cancel_reason TEXT, resumes INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, node_id);
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY, url TEXT, heartbeat REAL NOT NULL,
+                running INTEGER NOT NULL, capacity INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS artifacts (
+                filename TEXT PRIMARY KEY, node_id TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL
+            );
+        """)
+        _cluster_local.conn = conn
+    return conn
+
+@contextmanager
+def cluster_transaction():
+    """Transacción con lock de escritura desde el inicio: dos nodos nunca toman la misma tarea"""
+    conn = cluster_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def cluster_final_statuses() -> tuple:
+    return tuple(status.value for status in FINAL_STATUSES)
+
+def cluster_enqueue(task_id: str, url: str, quality: str, start_time: float, end_time: float, client: str, cost: float):
+    """Agrega una tarea a la cola compartida; la toma el primer nodo con un worker libre"""
+    now = time.time()
+    with cluster_transaction() as conn:
+        conn.execute(
+            "INSERT INTO jobs (task_id, url, quality, start_time, end_time, client, cost, created, status, progress, last_seen) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (task_id, url, quality, start_time, end_time, client, cost, now, TaskStatus.QUEUED.value,
+             json.dumps(TaskState(TaskStatus.QUEUED).to_dict()), now)
+        )
+    cluster_wakeup.set()
+
+def cluster_queued() -> int:
+    return cluster_connection().execute(
+        "SELECT COUNT(*) FROM jobs WHERE status = ? AND node_id IS NULL", (TaskStatus.QUEUED.value,)
+    ).fetchone()[0]
+
+def cluster_job(task_id: str):
+    return cluster_connection().execute("SELECT * FROM jobs WHERE task_id = ?", (task_id,)).fetchone()
+
+def cluster_touch(job: sqlite3.Row):
+    """Registra que un cliente consultó el progreso (como mucho una escritura por REAPER_INTERVAL)"""
+    now = time.time()
+    if now - job["last_seen"] > REAPER_INTERVAL:
+        cluster_connection().execute("UPDATE jobs SET last_seen = ? WHERE task_id = ?", (now, job["task_id"]))
+
+def cluster_cancel(task_id: str, reason: str):
+    """Cancela una tarea de la cola compartida. Devuelve False si ya terminó y None si no existe.
+    Si otro nodo la está descargando, ese nodo la cancela en su siguiente sincronización."""
+    message = CANCEL_MESSAGES[reason]
+    with cluster_transaction() as conn:
+        job = conn.execute("SELECT status, node_id FROM jobs WHERE task_id = ?", (task_id,)).fetchone()
+        if job is None:
+            return None
+        if job["status"] in cluster_final_statuses():
+            return False
+        if job["node_id"] is None:
+            # Todavía en cola: nadie más la va a terminar
+            state = TaskState(TaskStatus.CANCELLED, 0, message)
+            conn.execute(
+                "UPDATE jobs SET status = ?, progress = ?, result = ?, cancel_reason = ? WHERE task_id = ?",
+                (state.status.value, json.dumps(state.to_dict()), json.dumps({"error": message, "cancelled": True}), reason, task_id)
+            )
+        else:
+            conn.execute("UPDATE jobs SET cancel_reason = COALESCE(cancel_reason, ?) WHERE task_id = ?", (reason, task_id))
+    return True
+
+def cluster_claim(free: int, allow_large: bool) -> list:
+    """Toma tareas de la cola compartida para los workers libres de este nodo.
+
+    Entre clientes se prioriza al que tiene menos descargas en curso en todo el cluster
+    (ponderado por CLIENT_WEIGHTS); dentro de un cliente, la más corta con envejecimiento.
+    Solo se toman tareas cuyo espacio en disco cabe en este nodo."""
+    claimed = []
+    with cluster_transaction() as conn:
+        rows = conn.execute(
+            "SELECT task_id, url, quality, start_time, end_time, client, cost, created FROM jobs "
+            "WHERE status = ? AND node_id IS NULL ORDER BY created LIMIT ?",
+            (TaskStatus.QUEUED.value, CLUSTER_CLAIM_SCAN)
+        ).fetchall()
+        if not rows:
+            return claimed
+        running = dict(conn.execute(
+            f"SELECT client, COUNT(*) FROM jobs WHERE node_id IS NOT NULL AND status NOT IN ({','.join('?' * len(FINAL_STATUSES))}) GROUP BY client",
+            cluster_final_statuses()
+        ).fetchall())
+        available = {d: disk_available(d) for d in {DOWNLOAD_DIR, SCRATCH_DIR}}
+        now, wall = time.monotonic(), time.time()
+        candidates = []
+        for row in rows:
+            job = QueuedDownload(row["task_id"], row["client"], row["cost"],
+                                 (row["url"], row["quality"], row["start_time"], row["end_time"]))
+            job.enqueued = now - (wall - row["created"])  # La espera cuenta desde que entró a la cola compartida
+            candidates.append(job)
+        while candidates and len(claimed) < free:
+            eligible = [
+                job for job in candidates
+                if (allow_large or job.small) and all(need <= available[d] for d, need in job.needs.items())
+            ]
+            if not eligible:
+                break
+            job = min(eligible, key=lambda job: (running.get(job.client, 0) / client_weight(job.client), job.effective_cost(now)))
+            conn.execute("UPDATE jobs SET node_id = ?, status = ? WHERE task_id = ?",
+                         (NODE_ID, TaskStatus.STARTING.value, job.task_id))
+            candidates.remove(job)
+            claimed.append(job)
+            running[job.client] = running.get(job.client, 0) + 1
+            for d, need in job.needs.items():
+                available[d] -= need
+            allow_large = allow_large and job.small  # Una sola grande por toma: la siguiente espera un worker libre
+    return claimed
+
+def cluster_start_claimed(job: QueuedDownload):
+    """Crea el estado local de una tarea tomada de la cola compartida y la pasa al planificador"""
+    url, quality, start_time, end_time = job.args
+    download_progress[job.task_id] = TaskState(TaskStatus.QUEUED)
+    cluster_tasks.add(job.task_id)
+    # Diario local: protege los parciales del directorio de trabajo mientras la tarea vive
+    journal_task(job.task_id, url=url, quality=quality, start_time=start_time, end_time=end_time,
+                 created=time.time(), client=job.client, cost=job.cost)
+    schedule_download(job.task_id, url, quality, start_time, end_time, client=job.client, cost=job.cost)
+
+def cluster_sync_tasks():
+    """Publica el progreso de las tareas de este nodo y recoge cancelaciones y consultas hechas en otros nodos"""
+    if not cluster_tasks:
+        return
+    now_wall, now = time.time(), time.monotonic()
+    with cluster_transaction() as conn:
+        for task_id in list(cluster_tasks):
+            state = download_progress[task_id]
+            job = conn.execute("SELECT last_seen, cancel_reason FROM jobs WHERE task_id = ? AND node_id = ?",
+                               (task_id, NODE_ID)).fetchone()
+            if job is None:
+                # Otro nodo la recuperó (este nodo estuvo sin latido demasiado tiempo)
+                cluster_tasks.discard(task_id)
+                cluster_pushed.pop(task_id, None)
+                cancel_task(task_id, "reclaimed")
+                continue
+            
+            if job["cancel_reason"] and not state.cancel_reason:
+                cancel_task(task_id, job["cancel_reason"])
+            # Un cliente que consulta en otro nodo también mantiene viva la tarea
+            state.last_seen = max(state.last_seen, now - (now_wall - job["last_seen"]))
+            
+            final = state.status in FINAL_STATUSES
+            if final and task_id not in download_results:
+                continue  # El resultado se escribe justo después del estado: se publica en la siguiente vuelta
+            progress = json.dumps(state.to_dict())
+            if cluster_pushed.get(task_id) == progress:
+                continue
+            result = json.dumps(download_results[task_id]) if final else None
+            conn.execute("UPDATE jobs SET status = ?, progress = ?, result = ? WHERE task_id = ?",
+                         (state.status.value, progress, result, task_id))
+            cluster_pushed[task_id] = progress
+            
+            if final:
+                # El archivo ya quedó registrado en artifacts al publicarlo (ver place_unique)
+                cluster_tasks.discard(task_id)
+                cluster_pushed.pop(task_id, None)
+
+def cluster_requeue_node(conn: sqlite3.Connection, node_id: str, message: str, keep=()) -> int:
+    """Devuelve a la cola las tareas sin terminar de un nodo, salvo las de keep (las que ya
+    fallaron TASK_MAX_RESUMES veces terminan con error). Devuelve cuántas volvieron a la cola."""
+    final = cluster_final_statuses()
+    placeholders = ",".join("?" * len(final))
+    keep = list(keep)
+    keep_clause = f" AND task_id NOT IN ({','.join('?' * len(keep))})" if keep else ""
+    failed = TaskState(TaskStatus.ERROR, 0, "La descarga se interrumpió demasiadas veces. Intenta nuevamente.")
+    conn.execute(
+        f"UPDATE jobs SET node_id = NULL, status = ?, progress = ?, result = ? "
+        f"WHERE node_id = ? AND resumes >= ? AND status NOT IN ({placeholders}){keep_clause}",
+        (failed.status.value, json.dumps(failed.to_dict()), json.dumps({"error": failed.message}),
+         node_id, TASK_MAX_RESUMES, *final, *keep)
+    )
+    resumed = TaskState(TaskStatus.QUEUED, 0, message)
+    return conn.execute(
+        f"UPDATE jobs SET node_id = NULL, status = ?, progress = ?, resumes = resumes + 1 "
+        f"WHERE node_id = ? AND status NOT IN ({placeholders}){keep_clause}",
+        (resumed.status.value, json.dumps(resumed.to_dict()), node_id, *final, *keep)
+    ).rowcount
+
+def cluster_recover_own():
+    """Al arrancar con un NODE_ID fijo, el nodo sigue latiendo y cluster_reclaim nunca vería
+    caídas sus tareas anteriores: las que no está ejecutando vuelven a la cola"""
+    with cluster_transaction() as conn:
+        count = cluster_requeue_node(conn, NODE_ID, "Reanudando descarga tras reiniciar el nodo...", keep=set(cluster_tasks))
+    if count:
+        print(f"Recuperando {count} descarga(s) de una ejecución anterior del nodo {NODE_ID}")
+
+def cluster_reclaim():
+    """Devuelve a la cola las tareas de nodos sin latido (las toma otro nodo) y cancela las
+    tareas en cola que nadie consulta desde hace TASK_IDLE_TIMEOUT segundos"""
+    now = time.time()
+    with cluster_transaction() as conn:
+        dead = [row[0] for row in conn.execute("SELECT node_id FROM nodes WHERE heartbeat < ?", (now - NODE_DEAD_AFTER,))]
+        for node_id in dead:
+            count = cluster_requeue_node(conn, node_id, "Reanudando descarga en otro nodo...")
+            conn.execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
+            if count:
+                print(f"Recuperando {count} descarga(s) del nodo {node_id} (sin latido en {NODE_DEAD_AFTER:.0f}s)")
+        
+        if TASK_IDLE_TIMEOUT > 0:
+            message = CANCEL_MESSAGES["idle"]
+            state = TaskState(TaskStatus.CANCELLED, 0, message)
+            conn.execute(
+                "UPDATE jobs SET status = ?, progress = ?, result = ?, cancel_reason = 'idle' "
+                "WHERE status = ? AND node_id IS NULL AND last_seen < ?",
+                (state.status.value, json.dumps(state.to_dict()), json.dumps({"error": message, "cancelled": True}),
+                 TaskStatus.QUEUED.value, now - TASK_IDLE_TIMEOUT)
+            )
+
+def cluster_heartbeat():
+    with download_scheduler.cond:
+        running = download_scheduler.running
+    cluster_connection().execute(
+        "INSERT OR REPLACE INTO nodes (node_id, url, heartbeat, running, capacity) VALUES (?, ?, ?, ?, ?)",
+        (NODE_ID, NODE_URL or None, time.time(), running, download_scheduler.workers)
+    )
+
+def cluster_loop():
+    """Latido, publicación de progreso, recuperación de nodos caídos y toma de tareas"""
+    recovered = False
+    while True:
+        try:
+            cluster_heartbeat()
+            if not recovered:
+                cluster_recover_own()  # Antes de tomar tareas nuevas
+                recovered = True
+            cluster_sync_tasks()
+            cluster_reclaim()
+            free, allow_large = download_scheduler.capacity()
+            if free > 0:
+                for job in cluster_claim(free, allow_large):
+                    cluster_start_claimed(job)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Warning: Error sincronizando con la cola compartida: {e}")
+        cluster_wakeup.wait(CLUSTER_POLL_INTERVAL)
+        cluster_wakeup.clear()
+
+def start_cluster_node():
+    """Inicia el hilo del nodo (una sola vez por proceso)"""
+    global _cluster_started
+    if _cluster_started:
+        return
+    with cluster_start_lock:
+        if not _cluster_started:
+            threading.Thread(target=cluster_loop, name="cluster-node", daemon=True).start()
+            _cluster_started = True
+            print(f"Nodo {NODE_ID} conectado a la cola compartida {CLUSTER_DB}")
+
+def cluster_reserve_name(filename: str) -> bool:
+    """Reserva un nombre de archivo para este nodo en toda la cola compartida (size -1 mientras
+    se publica). False si otro nodo, o una tarea de este, ya lo usa."""
+    try:
+        cluster_connection().execute(
+            "INSERT INTO artifacts (filename, node_id, size, created) VALUES (?, ?, -1, ?)",
+            (filename, NODE_ID, time.time())
+        )
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+def cluster_release_name(filename: str):
+    """Libera una reserva de nombre que no llegó a publicarse"""
+    cluster_connection().execute(
+        "DELETE FROM artifacts WHERE filename = ? AND node_id = ? AND size < 0", (filename, NODE_ID)
+    )
+
+def cluster_publish_name(filename: str, size: int):
+    cluster_connection().execute(
+        "UPDATE artifacts SET size = ?, created = ? WHERE filename = ? AND node_id = ?",
+        (size, time.time(), filename, NODE_ID)
+    )
+
+def cluster_artifact_node(filename: str):
+    """URL base del nodo vivo que tiene el archivo, o None"""
+    row = cluster_connection().execute(
+        "SELECT nodes.url FROM artifacts JOIN nodes ON nodes.node_id = artifacts.node_id "
+        "WHERE artifacts.filename = ? AND artifacts.size >= 0 AND nodes.node_id != ? AND nodes.url IS NOT NULL "
+        "AND nodes.heartbeat >= ?",
+        (filename, NODE_ID, time.time() - NODE_DEAD_AFTER)
+    ).fetchone()
+    return row[0] if row else None
+
+def cluster_artifact_url(filename: str):
+    """URL del archivo en el nodo vivo que lo tiene, o None"""
+    node_url = cluster_artifact_node(filename)
+    return f"{node_url}/downloads/{quote(filename)}" if node_url else None
+
+def cluster_remote_artifacts() -> list:
+    """Archivos de otros nodos vivos"""
+    return cluster_connection().execute(
+        "SELECT artifacts.filename, artifacts.size, artifacts.created, artifacts.node_id FROM artifacts "
+        "JOIN nodes ON nodes.node_id = artifacts.node_id "
+        "WHERE artifacts.node_id != ? AND artifacts.size >= 0 AND nodes.heartbeat >= ?",
+        (NODE_ID, time.time() - NODE_DEAD_AFTER)
+    ).fetchall()
 
 @app.route("/api/detect-platform", methods=["POST"])
 def api_detect_platform():
-    """Detecta la plataforma de una URL"""
+    """Detecta la plataforma de una URL y empieza a sondear sus formatos en segundo plano,
+    para que /api/formats/list responda con el resultado ya calculado"""
     try:
         data = request.get_json()
         url = (data.get("url") or "").strip()
@@ -667,25 +2670,118 @@ def api_detect_platform():
             return jsonify({"error": "URL inválida"}), 400
         
         platform = detect_platform(url)
+        platform["canonical_url"] = canonical_url(url)
+        
+        probe = None
+        if prefetch_url_error(url) is None:
+            # Sesión del sondeo: la página manda un id por pestaña; si no, se usa el cliente
+            session = str(data.get("session") or "")[:64] or request_client_id()
+            probe, _ = start_formats_probe(url, session)
+        platform["prefetch"] = probe is not None
         return jsonify(platform)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/formats/list", methods=["POST"])
-def api_list_formats():
-    """Obtiene la lista de formatos disponibles para una URL"""
-    data = request.get_json()
-    url = (data.get("url") or "").strip()
-    
-    if not url:
-        return jsonify({"error": "URL vacía"}), 400
-    
-    if not url.startswith("http"):
-        return jsonify({"error": "URL inválida"}), 400
+def prefetch_url_error(url: str):
+    """Motivo por el que una URL no se puede sondear todavía (p. ej. a medio escribir), o None.
+    De las plataformas conocidas solo se sondean URLs con un id de video completo; del resto,
+    las que tienen una ruta (https://www.you o https://ejemplo.com/ no se sondean)."""
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return "URL inválida"
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return "URL inválida"
+    host = parsed.hostname
+    if "." not in host and host != "localhost":
+        return "URL incompleta"
+    classified = classify_url(url)
+    if classified.platform:
+        if not PREFETCH_MEDIA_RE[classified.platform].fullmatch(classified.canonical):
+            return "URL incompleta"
+    elif not parsed.path.strip("/"):
+        return "URL incompleta"
+    return None
+
+def start_formats_probe(url: str, session: str = None):
+    """Devuelve (sondeo, si quien llama debe ejecutarlo), reutilizando uno en curso o reciente.
+
+    Con session (sondeo anticipado) el sondeo corre en formats_probe_pool y reemplaza al
+    anterior de la misma sesión: si ese todavía no empezó y nadie más lo espera, se cancela.
+    Si ya hay FORMATS_PROBE_WORKERS sondeos anticipados sin terminar no se lanza otro y se
+    devuelve (None, False): la sesión la elige el cliente y no debe poder llenar la cola.
+    Sin session, quien llama ejecuta el sondeo (ver formats_probe_result)."""
+    key = canonical_url(url)
+    now = time.monotonic()
+    owner = False
+    with formats_probes_lock:
+        if session:
+            previous = session_probes.pop(session, None)
+            if previous is not None and previous != key:
+                superseded = formats_probes.get(previous)
+                if superseded is not None:
+                    superseded.sessions.discard(session)
+                    # Future.cancel() solo tiene efecto si el sondeo todavía espera un worker
+                    if superseded.speculative and not superseded.sessions and superseded.future.cancel():
+                        del formats_probes[previous]
+        
+        probe = formats_probes.get(key)
+        if probe is not None and probe.usable(now):
+            formats_probes.move_to_end(key)
+            if session is None:
+                probe.speculative = False
+        elif session and not formats_probe_slots.acquire(blocking=False):
+            return None, False
+        else:
+            if session:
+                future = formats_probe_pool.submit(build_formats_response, url)
+                future.add_done_callback(lambda _: formats_probe_slots.release())
+            else:
+                future = Future()
+            probe = formats_probes[key] = FormatsProbe(future, speculative=session is not None)
+            owner = session is None
+            while len(formats_probes) > FORMATS_PROBE_CACHE_SIZE:
+                _, evicted = formats_probes.popitem(last=False)
+                if evicted.speculative:
+                    evicted.future.cancel()  # Sin entrada en la caché nadie podría usar su resultado
+        
+        if session:
+            session_probes[session] = key
+            while len(session_probes) > SESSION_PROBES_SIZE:
+                session_probes.popitem(last=False)
+            probe.sessions.add(session)
+    return probe, owner
+
+def formats_probe_result(url: str):
+    """(respuesta, código HTTP) de /api/formats/list, usando el sondeo anticipado si existe"""
+    probe, owner = start_formats_probe(url)
+    if owner:
+        # Nadie sondeaba esta URL: se sondea en este hilo y los requests simultáneos esperan el resultado
+        probe.future.set_running_or_notify_cancel()
+        try:
+            result = build_formats_response(url)
+        except BaseException as e:
+            probe.future.set_exception(e)
+            raise
+        probe.future.set_result(result)
+    else:
+        result = probe.future.result()
     
+    if result[1] != 200:
+        # Los errores (timeouts, bloqueos temporales) no se reutilizan
+        with formats_probes_lock:
+            key = canonical_url(url)
+            if formats_probes.get(key) is probe:
+                del formats_probes[key]
+    return result
+
+def build_formats_response(url: str):
+    """Extrae los formatos disponibles de una URL con yt-dlp.
+    Devuelve (respuesta, código HTTP); la usan /api/formats/list y el sondeo anticipado."""
     try:
-        clean_url = clean_youtube_url(url)
-        is_youtube = "youtube.com" in clean_url.lower() or "youtu.be" in clean_url.lower()
+        classified = classify_url(url)
+        clean_url = classified.canonical
+        is_youtube = classified.platform == "youtube"
         
         list_opts = {
             'quiet': True,
@@ -721,10 +2817,10 @@ def api_list_formats():
             # Manejar errores de importación de módulos de yt-dlp
             error_msg = str(import_error)
             if 'extractor' in error_msg.lower() or 'extractors' in error_msg.lower():
-                return jsonify({
+                return {
                     "error": "Error de configuración de yt-dlp",
                     "details": "Por favor, reinstala yt-dlp ejecutando: pip install --upgrade --force-reinstall 'yt-dlp[default]'"
-                }), 500
+                }, 500
             raise
         except Exception as extract_error:
             error_str = str(extract_error).lower()
@@ -746,7 +2842,7 @@ def api_list_formats():
                     except Exception:
                         # Si ambas fallan, devolver respuesta parcial indicando que los formatos no están disponibles
                         # pero la descarga puede continuar
-                        return jsonify({
+                        return {
                             'formats': [
                                 {'value': 'best', 'label': 'Mejor disponible', 'height': None},
                                 {'value': 'audio', 'label': 'Solo audio (MP3)', 'height': None}
@@ -756,10 +2852,10 @@ def api_list_formats():
                             'duration': 0,
                             'duration_formatted': '',
                             'warning': 'No se pudieron obtener los formatos específicos. Usa "Mejor disponible" para descargar.'
-                        }), 200
+                        }, 200
                 else:
                     # Devolver respuesta parcial en lugar de error 500
-                    return jsonify({
+                    return {
                         'formats': [
                             {'value': 'best', 'label': 'Mejor disponible', 'height': None},
                             {'value': 'audio', 'label': 'Solo audio (MP3)', 'height': None}
@@ -767,7 +2863,7 @@ def api_list_formats():
                         'available_heights': [],
                         'platform': detect_platform(url),
                         'warning': 'No se pudieron obtener los formatos específicos. Usa "Mejor disponible" para descargar.'
-                    }), 200
+                    }, 200
             else:
                 # Para otros errores, intentar con URL original
                 if clean_url != url:
@@ -784,6 +2880,9 @@ def api_list_formats():
         if not formats and info:
             formats = info.get('formats', [])
         
+        # Recordar los tamaños por calidad para estimar el costo si luego se descarga
+        remember_format_estimate(url, info, formats)
+        
         # Procesar formatos para extraer información útil
         processed_formats = []
         seen_heights = set()
@@ -852,6 +2951,15 @@ def api_list_formats():
             {'value': 'audio', 'label': 'Solo audio (MP3)', 'height': None},
         ]
         
+        # Si hay audio que se puede copiar sin recodificar, ofrecerlo (más rápido que MP3)
+        copyable_audio = choose_audio_format(formats, AUDIO_CONTAINERS)
+        if copyable_audio:
+            special_formats.append({
+                'value': 'audio_original',
+                'label': f"Solo audio original ({copyable_audio[1].upper()}, sin recodificar)",
+                'height': None
+            })
+        
         # Agregar formatos de video disponibles
         video_formats = [f for f in processed_formats if f['has_video']]
         for fmt in video_formats:
@@ -882,13 +2990,13 @@ def api_list_formats():
                 else:
                     duration_formatted = f"{minutes}:{seconds:02d}"
         
-        return jsonify({
+        return {
             'formats': special_formats,
             'available_heights': sorted(seen_heights, reverse=True),
             'platform': detect_platform(url),
             'duration': video_duration,
             'duration_formatted': duration_formatted
-        })
+        }, 200
         
     except Exception as e:
         error_str = str(e).lower()
@@ -898,21 +3006,49 @@ def api_list_formats():
         print(traceback.format_exc())
         
         if "timeout" in error_str or "timed out" in error_str:
-            return jsonify({"error": "Timeout al obtener formatos. El servidor no respondió a tiempo."}), 500
+            return {"error": "Timeout al obtener formatos. El servidor no respondió a tiempo."}, 500
         elif "private video" in error_str or "sign in" in error_str or "private" in error_str:
-            return jsonify({"error": "Este video es privado o requiere autenticación."}), 400
+            return {"error": "Este video es privado o requiere autenticación."}, 400
         elif "video unavailable" in error_str or "unavailable" in error_str or "does not exist" in error_str:
-            return jsonify({"error": "Este video no está disponible."}), 400
+            return {"error": "Este video no está disponible."}, 400
         elif "age-restricted" in error_str or "age restricted" in error_str:
-            return jsonify({"error": "Este video tiene restricción de edad."}), 400
+            return {"error": "Este video tiene restricción de edad."}, 400
         elif "region" in error_str or "not available in your country" in error_str:
-            return jsonify({"error": "Este video no está disponible en tu región."}), 400
+            return {"error": "Este video no está disponible en tu región."}, 400
         else:
             # Devolver un error más descriptivo
-            return jsonify({
+            return {
                 "error": f"Error al obtener formatos: {str(e)}",
                 "details": "No se pudieron obtener los formatos disponibles. Intenta descargar directamente con 'Mejor disponible'."
-            }), 500
+            }, 500
+
+@app.route("/api/formats/list", methods=["POST"])
+@profiled
+def api_list_formats():
+    """Obtiene la lista de formatos disponibles para una URL.
+    Si /api/detect-platform ya la sondeó (o el sondeo sigue en curso) se usa ese resultado."""
+    data = request.get_json()
+    url = (data.get("url") or "").strip()
+    
+    if not url:
+        return jsonify({"error": "URL vacía"}), 400
+    
+    if not url.startswith("http"):
+        return jsonify({"error": "URL inválida"}), 400
+    
+    if PROFILING_ENABLED and request.headers.get(PROFILE_HEADER):
+        # Perfilado: el trabajo tiene que correr en este hilo, no en un sondeo anticipado
+        response, status = build_formats_response(url)
+    else:
+        response, status = formats_probe_result(url)
+    if status == 200 and 'duration' in response:
+        # Si esta URL ya se descargó completa, su tira de fotogramas ayuda a elegir el recorte
+        # (se consulta en cada request: el sondeo puede ser anterior a la descarga)
+        preview_file = completed_downloads.get(canonical_url(url))
+        if preview_file and not os.path.exists(os.path.join(DOWNLOAD_DIR, preview_file)):
+            preview_file = None
+        response = {**response, 'preview': preview_strip_url(preview_file) if preview_file else None}
+    return jsonify(response), status
 
 @app.route("/api/download/start", methods=["POST"])
 def api_download_start():
@@ -930,6 +3066,9 @@ def api_download_start():
         if not url.startswith("http"):
             return jsonify({"error": "URL inválida"}), 400
         
+        if quality.startswith("audio") and parse_audio_quality(quality) is None:
+            return jsonify({"error": f"Formato de audio no soportado. Usa: audio, audio_original o audio_{{{','.join(AUDIO_CONTAINERS)}}}"}), 400
+        
         # Validar tiempos si se proporcionan
         if start_time is not None or end_time is not None:
             # Convertir a float si son strings
@@ -955,34 +3094,89 @@ def api_download_start():
         # Generar task_id único
         task_id = str(uuid.uuid4())
         
+        # Costo estimado (bytes) para la planificación, con lo que dejó /api/formats/list
+        client = request_client_id()
+        cost = estimate_task_cost(url, quality)
+        
+        # Rechazar si no cabría ni con todo el disco libre; si cabe más tarde, queda en cola
+        shortfall = disk_shortfall(disk_needs(cost))
+        if shortfall:
+            return jsonify({
+                "error": f"Espacio en disco insuficiente para esta descarga (faltan ~{shortfall / (1024 * 1024):.0f} MB). Intenta con una calidad menor.",
+                "estimated_bytes": int(cost)
+            }), 507
+        
+        if CLUSTER_DB:
+            # Modo distribuido: la toma el primer nodo con un worker libre
+            cluster_enqueue(task_id, url, quality, start_time, end_time, client, cost)
+            return jsonify({"task_id": task_id, "estimated_bytes": int(cost), "queued": cluster_queued()})
+        
         # Inicializar progreso
-        download_progress[task_id] = {
-            "status": "starting",
-            "percent": 0,
-            "message": "Iniciando descarga..."
-        }
+        download_progress[task_id] = TaskState(TaskStatus.QUEUED)
+        
+        # Registrar la tarea en el diario antes de empezar para poder reanudarla tras un reinicio
+        journal_task(task_id, url=url, quality=quality, start_time=start_time, end_time=end_time,
+                     created=time.time(), client=client, cost=cost)
         
-        # Iniciar descarga en un hilo separado
-        thread = threading.Thread(target=download_video_task, args=(task_id, url, quality, start_time, end_time))
-        thread.daemon = True
-        thread.start()
+        # Encolar la descarga; empieza en cuanto el planificador le da un worker
+        schedule_download(task_id, url, quality, start_time, end_time, client=client, cost=cost)
         
-        return jsonify({"task_id": task_id})
+        return jsonify({"task_id": task_id, "estimated_bytes": int(cost), "queued": download_scheduler.queued()})
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/download/trace/<task_id>")
+def api_download_trace(task_id):
+    """Devuelve la línea de tiempo de spans de una descarga"""
+    with trace_lock:
+        spans = [s for s in trace_spans if s["attributes"].get("task_id") == task_id]
+    
+    if not spans:
+        return jsonify({"error": "No hay trazas para este Task ID"}), 404
+    
+    spans.sort(key=lambda s: s["start_time_unix_nano"])
+    trace_start = spans[0]["start_time_unix_nano"]
+    timeline = []
+    for span in spans:
+        timeline.append({
+            **span,
+            # Desplazamiento desde el inicio de la traza, útil para dibujar la línea de tiempo
+            "offset_ms": round((span["start_time_unix_nano"] - trace_start) / 1e6, 3),
+        })
+    
+    root = next((s for s in spans if s["parent_span_id"] is None), None)
+    return jsonify({
+        "task_id": task_id,
+        "trace_id": spans[0]["trace_id"],
+        "total_ms": root["duration_ms"] if root else None,
+        "spans": timeline,
+    })
+
 @app.route("/api/download/progress/<task_id>")
 def api_download_progress(task_id):
     """Consulta el progreso de una descarga"""
     try:
+        if CLUSTER_DB and task_id not in cluster_tasks:
+            # En cola, en otro nodo o ya terminada: el estado publicado está en la cola compartida
+            job = cluster_job(task_id)
+            if job is None:
+                return jsonify({"error": "Task ID no encontrado"}), 404
+            cluster_touch(job)
+            progress = json.loads(job["progress"])
+            if job["result"]:
+                progress["result"] = json.loads(job["result"])
+            return jsonify(progress)
+        
         if task_id not in download_progress:
             return jsonify({"error": "Task ID no encontrado"}), 404
         
-        progress = download_progress[task_id].copy()
+        state = download_progress[task_id]
+        state.last_seen = time.monotonic()  # El cliente sigue esperando el resultado
+        progress = state.to_dict()
         
         # Si la descarga está completada o con error, incluir resultados
-        if progress["status"] in ["completed", "error"]:
+        if state.status in FINAL_STATUSES:
             if task_id in download_results:
                 progress["result"] = download_results[task_id]
         
@@ -991,6 +3185,25 @@ def api_download_progress(task_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/download/<task_id>", methods=["DELETE"])
+def api_download_cancel(task_id):
+    """Cancela una descarga en curso y elimina sus archivos parciales"""
+    if CLUSTER_DB and task_id not in cluster_tasks:
+        cancelled = cluster_cancel(task_id, "user")
+        if cancelled is None:
+            return jsonify({"error": "Task ID no encontrado"}), 404
+        if not cancelled:
+            return jsonify({"error": "La descarga ya terminó", "status": cluster_job(task_id)["status"]}), 409
+        cluster_wakeup.set()
+        return jsonify({"task_id": task_id, "status": "cancelling"}), 202
+    
+    state = download_progress.get(task_id)
+    if state is None:
+        return jsonify({"error": "Task ID no encontrado"}), 404
+    if not cancel_task(task_id, "user"):
+        return jsonify({"error": "La descarga ya terminó", "status": state.status.value}), 409
+    return jsonify({"task_id": task_id, "status": "cancelling"}), 202
+
 @app.route("/download", methods=["GET"])
 def download():
     """Página de descarga de videos"""
@@ -998,17 +3211,92 @@ def download():
 
 @app.route("/downloads/<filename>")
 def serve_download(filename):
-    """Sirve archivos descargados"""
+    """Sirve archivos descargados (en modo distribuido, redirige al nodo que tiene el archivo)"""
+    if CLUSTER_DB and not os.path.isfile(os.path.join(DOWNLOAD_DIR, os.path.basename(filename))):
+        node_url = cluster_artifact_url(filename)
+        if node_url:
+            return redirect(node_url)
     try:
         return send_from_directory(DOWNLOAD_DIR, filename, as_attachment=True)
     except Exception as e:
         return jsonify({"error": str(e)}), 404
 
+@app.route("/api/previews/strip/<filename>")
+def api_preview_strip(filename):
+    """Tira de fotogramas clave de una descarga completada (para elegir puntos de recorte)"""
+    if os.path.basename(filename) != filename or filename.startswith('.') or PARTIAL_FILE_RE.search(filename):
+        return jsonify({"error": "Archivo no encontrado"}), 404
+    if not os.path.isfile(os.path.join(DOWNLOAD_DIR, filename)):
+        node_url = cluster_artifact_node(filename) if CLUSTER_DB else None
+        if node_url:
+            return cluster_proxy_strip(node_url, filename)
+        return jsonify({"error": "Archivo no encontrado"}), 404
+    if (mimetypes.guess_type(filename)[0] or "").startswith("audio/"):
+        return jsonify({"error": "Solo hay vista previa para archivos de video"}), 400
+    
+    try:
+        frames = int(request.args.get("frames", STRIP_FRAMES))
+    except ValueError:
+        return jsonify({"error": "frames debe ser un número entero"}), 400
+    if not 2 <= frames <= STRIP_MAX_FRAMES:
+        return jsonify({"error": f"frames debe estar entre 2 y {STRIP_MAX_FRAMES}"}), 400
+    
+    try:
+        meta = build_keyframe_strip(filename, frames)
+    except FileNotFoundError:
+        return jsonify({"error": "FFmpeg no está instalado"}), 503
+    except (ValueError, subprocess.TimeoutExpired) as e:
+        return jsonify({"error": str(e)}), 422
+    
+    response = jsonify(meta)
+    response.cache_control.max_age = 60  # El archivo puede reemplazarse con una nueva descarga
+    return response
+
+def cluster_proxy_strip(node_url: str, filename: str):
+    """Pide la tira al nodo que tiene el archivo. Se hace desde el servidor porque la página
+    la pide con fetch (una redirección a otro origen necesitaría CORS); la imagen sí se
+    carga directamente del otro nodo."""
+    try:
+        r = requests.get(f"{node_url}/api/previews/strip/{quote(filename)}", params=request.args, timeout=310)
+        meta = r.json()
+    except (requests.RequestException, ValueError) as e:
+        return jsonify({"error": f"No se pudo obtener la vista previa del nodo {node_url}: {e}"}), 502
+    if r.status_code == 200 and str(meta.get("url", "")).startswith("/"):
+        meta["url"] = node_url + meta["url"]
+    response = jsonify(meta)
+    response.status_code = r.status_code
+    response.cache_control.max_age = 60
+    return response
+
+@app.route("/previews/<filename>")
+def serve_preview(filename):
+    """Sirve miniaturas y tiras desde la caché local con cabeceras de caché inmutables"""
+    key, ext = os.path.splitext(filename)
+    if not re.fullmatch(r"[0-9a-f]{32}", key) or ext != ".jpg":
+        return jsonify({"error": "Vista previa no encontrada"}), 404
+    
+    path = os.path.join(PREVIEW_CACHE_DIR, filename)
+    if not os.path.exists(path):
+        try:
+            path = fetch_thumbnail(key)
+        except (requests.RequestException, ValueError, OSError, subprocess.SubprocessError) as e:
+            # Sin ffmpeg o con la miniatura inaccesible, el navegador la pide directamente
+            print(f"Warning: No se pudo generar la miniatura {key}: {e}")
+            return redirect(lookup_source(PREVIEW_CACHE_DIR, key, thumbnail_sources))
+        if path is None:
+            return jsonify({"error": "Vista previa no encontrada"}), 404
+    
+    response = send_file(path, mimetype="image/jpeg", etag=key, max_age=PREVIEW_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route("/api/downloads/list")
 def list_downloads():
     """Lista todos los archivos descargados disponibles"""
     try:
-        files = [f for f in os.listdir(DOWNLOAD_DIR) if os.path.isfile(os.path.join(DOWNLOAD_DIR, f)) and not f.startswith('.')]
+        files = [f for f in os.listdir(DOWNLOAD_DIR) if os.path.isfile(os.path.join(DOWNLOAD_DIR, f))
+                 and not f.startswith('.') and not PARTIAL_FILE_RE.search(f)]
         
         downloads_list = []
         for filename in files:
@@ -1025,6 +3313,23 @@ def list_downloads():
                 "url": url_for("serve_download", filename=filename)
             })
         
+        # Archivos de otros nodos: la URL local redirige al nodo que los tiene
+        if CLUSTER_DB:
+            local_files = set(files)
+            for artifact in cluster_remote_artifacts():
+                if artifact["filename"] in local_files:
+                    continue
+                created = datetime.fromtimestamp(artifact["created"])
+                downloads_list.append({
+                    "filename": artifact["filename"],
+                    "size": artifact["size"],
+                    "size_mb": round(artifact["size"] / (1024 * 1024), 2),
+                    "modified": created.isoformat(),
+                    "modified_readable": created.strftime("%Y-%m-%d %H:%M:%S"),
+                    "url": url_for("serve_download", filename=artifact["filename"]),
+                    "node": artifact["node_id"]
+                })
+        
         # Ordenar por fecha de modificación (más recientes primero)
         downloads_list.sort(key=lambda x: x["modified"], reverse=True)
         
@@ -1035,17 +3340,140 @@ def list_downloads():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/cluster/status")
+def api_cluster_status():
+    """Nodos del modo distribuido con su latido y carga, y tareas en la cola compartida"""
+    if not CLUSTER_DB:
+        return jsonify({"error": "Modo distribuido deshabilitado (CLUSTER_DB)"}), 404
+    
+    now = time.time()
+    nodes = [
+        {
+            "node_id": row["node_id"],
+            "url": row["url"],
+            "alive": now - row["heartbeat"] < NODE_DEAD_AFTER,
+            "heartbeat_age": round(now - row["heartbeat"], 1),
+            "running": row["running"],
+            "capacity": row["capacity"],
+        }
+        for row in cluster_connection().execute("SELECT * FROM nodes ORDER BY node_id")
+    ]
+    return jsonify({"node_id": NODE_ID, "nodes": nodes, "queued": cluster_queued()})
+
+@app.route("/api/debug/profile", methods=["POST"])
+def api_profile_process():
+    """Perfila todo el proceso durante N segundos y devuelve las pilas en formato collapsed"""
+    if not PROFILING_ENABLED:
+        return jsonify({"error": "Perfilado deshabilitado (PROFILING_ENABLED=1)"}), 404
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        seconds = float(data.get("seconds") or request.args.get("seconds") or 10)
+        interval = float(data.get("interval") or request.args.get("interval") or 0.005)
+    except (ValueError, TypeError):
+        return jsonify({"error": "seconds e interval deben ser números válidos"}), 400
+    
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"error": f"seconds debe estar entre 0 y {PROFILE_MAX_SECONDS}"}), 400
+    if not 0.0005 <= interval <= 1:
+        return jsonify({"error": "interval debe estar entre 0.0005 y 1 segundo"}), 400
+    
+    # Excluir el hilo de este request, que solo espera al profiler
+    sampler = profile_process(seconds, interval, exclude={threading.get_ident()})
+    return app.response_class(
+        sampler.collapsed() + "\n",
+        mimetype="text/plain",
+        headers={"X-Profile-Samples": str(sampler.samples)}
+    )
+
+@app.route("/api/debug/profile/<profile_id>")
+def api_request_profile(profile_id):
+    """Devuelve el perfil de un request marcado con el header X-Profile"""
+    if not PROFILING_ENABLED:
+        return jsonify({"error": "Perfilado deshabilitado (PROFILING_ENABLED=1)"}), 404
+    
+    profile = request_profiles.get(profile_id)
+    if profile is None:
+        return jsonify({"error": "Perfil no encontrado"}), 404
+    
+    if request.args.get("format") == "collapsed":
+        return app.response_class(profile["collapsed"] + "\n", mimetype="text/plain")
+    return jsonify(profile)
+
 @app.before_request
 def before_request():
     """Limpia archivos antiguos antes de cada request (solo ocasionalmente para no afectar performance)"""
+    global _journal_resumed
+    if CLUSTER_DB:
+        start_cluster_node()  # Respaldo para `flask run` (normalmente ya se inició al arrancar)
+    
+    # Reanudar las descargas interrumpidas con el primer request del proceso que atiende
+    # (no al importar: el proceso padre del reloader de Flask no debe descargar)
+    if not _journal_resumed:
+        _journal_resumed = True
+        try:
+            resume_journaled_tasks()
+        except OSError as e:
+            print(f"Warning: No se pudieron reanudar las descargas del diario: {e}")
+    
     # Solo limpiar 1 de cada 100 requests para no afectar performance
     if random.randint(1, 100) == 1:
         cleanup_old_files()
 
+def iter_snapshot_json(source: str):
+    """Recorre un volcado de PokeAPI en JSON (archivos sueltos, listas o el repo api-data)"""
+    paths = [source] if os.path.isfile(source) else sorted(
+        os.path.join(root, f) for root, _, files in os.walk(source) for f in files if f.endswith(".json")
+    )
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            try:
+                content = json.load(f)
+            except ValueError:
+                continue
+        for data in content if isinstance(content, list) else [content]:
+            # Solo los recursos de Pokémon tienen estas tres claves
+            if isinstance(data, dict) and data.get("name") and "moves" in data and "types" in data:
+                yield project_pokemon(data, data["name"])
+
+def iter_snapshot_online():
+    """Descarga todos los Pokémon desde POKEAPI_BASE_URL usando el pool de consultas"""
+    names = list_pokemon_names()
+    futures = [pokeapi_pool.submit(fetch_pokemon, name) for name in names]
+    for position, future in enumerate(futures, start=1):
+        projection = future.result()
+        if projection is not None:
+            yield projection
+        if position % 100 == 0:
+            print(f"  {position}/{len(names)} Pokémon descargados")
+
+@app.cli.command("pokeapi-snapshot")
+@click.option("--source", default=None, help="Archivo o directorio con JSON de PokeAPI. Sin valor, se descarga desde POKEAPI_BASE_URL.")
+@click.option("--output", default=POKEAPI_SNAPSHOT, show_default=True, help="Ruta del snapshot SQLite.")
+def pokeapi_snapshot_command(source, output):
+    """Construye o actualiza el snapshot local usado con POKEAPI_OFFLINE=1"""
+    if POKEAPI_OFFLINE and not source:
+        raise click.UsageError("Con POKEAPI_OFFLINE=1 indica --source para no leer del snapshot que se está reemplazando")
+    start = time.perf_counter()
+    projections = iter_snapshot_json(source) if source else iter_snapshot_online()
+    count = build_pokemon_snapshot(output, projections)
+    click.echo(f"Snapshot con {count} Pokémon guardado en {output} ({time.perf_counter() - start:.1f}s)")
+
+# Modo distribuido: el nodo late y toma tareas desde que arranca, aunque no reciba tráfico.
+# Se inicia al importar el módulo en un servidor WSGI (gunicorn, etc.), pero no con los comandos
+# `flask` (pokeapi-snapshot no debe descargar); con `python app.py`, en el bloque de abajo
+if CLUSTER_DB and __name__ != "__main__" and os.environ.get("FLASK_RUN_FROM_CLI") != "true":
+    start_cluster_node()
+
 if __name__ == "__main__":
     # Suprimir advertencias adicionales al iniciar
     logging.getLogger('werkzeug').setLevel(logging.ERROR)
     
+    # Con debug el reloader ejecuta este archivo en un proceso padre que no atiende requests:
+    # el nodo solo se inicia en el proceso hijo (WERKZEUG_RUN_MAIN)
+    if CLUSTER_DB and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_cluster_node()
+    
     # Ejecuta: python app.py
     app.run(host="127.0.0.1", port=5001, debug=True)
 
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Servidor local que imita PokeAPI para benchmarks sin internet.
+
+Sirve:
+- GET /api/v2/pokemon?limit=N        -> {"count": ..., "results": [{"name", "url"}]}
+- GET /api/v2/pokemon/{name}         -> payload con types, moves, sprites y
+                                        secciones grandes no usadas (game_indices)
+"""
+import json
+import random
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Nombres reales para que las búsquedas y sugerencias se parezcan a producción
+BASE_NAMES = [
+    "bulbasaur", "ivysaur", "venusaur", "charmander", "charmeleon", "charizard",
+    "squirtle", "wartortle", "blastoise", "caterpie", "metapod", "butterfree",
+    "pikachu", "raichu", "jigglypuff", "meowth", "psyduck", "machop", "geodude",
+    "gengar", "onix", "eevee", "snorlax", "mewtwo", "mew", "lucario", "garchomp",
+]
+TYPES = ["normal", "fire", "water", "grass", "electric", "psychic", "ghost", "dragon", "rock", "fighting"]
+SPRITE_BASE = "https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon"
+
+
+def build_names(total: int = 1300) -> list:
+    """Genera una lista determinista de nombres con el mismo tamaño aproximado que PokeAPI"""
+    names = list(BASE_NAMES)
+    i = 0
+    while len(names) < total:
+        names.append(f"{BASE_NAMES[i % len(BASE_NAMES)]}-form{i // len(BASE_NAMES) + 1}")
+        i += 1
+    return names
+
+
+def build_pokemon(name: str, index: int, moves: int = 120) -> dict:
+    """Construye un payload con la misma forma que /api/v2/pokemon/{name}"""
+    rnd = random.Random(name)
+    return {
+        "id": index,
+        "name": name,
+        "types": [{"slot": i + 1, "type": {"name": t, "url": ""}} for i, t in enumerate(rnd.sample(TYPES, 2))],
+        "moves": [
+            {
+                "move": {"name": f"move-{rnd.randint(1, 900)}", "url": ""},
+                "version_group_details": [
+                    {"level_learned_at": rnd.randint(1, 60), "version_group": {"name": f"vg-{v}", "url": ""}}
+                    for v in range(6)
+                ],
+            }
+            for _ in range(moves)
+        ],
+        "sprites": {
+            "front_default": f"{SPRITE_BASE}/{index}.png",
+            "front_shiny": f"{SPRITE_BASE}/shiny/{index}.png",
+            "back_default": f"{SPRITE_BASE}/back/{index}.png",
+            "back_shiny": f"{SPRITE_BASE}/back/shiny/{index}.png",
+        },
+        # Secciones grandes que la aplicación no usa, para que el parseo cueste lo mismo
+        "game_indices": [{"game_index": index, "version": {"name": f"version-{v}", "url": ""}} for v in range(40)],
+        "held_items": [],
+        "stats": [{"base_stat": rnd.randint(20, 150), "stat": {"name": f"stat-{s}", "url": ""}} for s in range(6)],
+    }
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Los clientes cierran conexiones a mitad de respuesta con frecuencia; no es un error
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class FakePokeAPIHandler(BaseHTTPRequestHandler):
+    names = build_names()
+    index = {name: i + 1 for i, name in enumerate(names)}
+    payload_cache = {}
+    latency = 0.0  # Latencia artificial en segundos
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+        parsed = urlparse(self.path)
+        path = parsed.path.rstrip("/")
+
+        if path == "/api/v2/pokemon":
+            query = parse_qs(parsed.query)
+            limit = int(query.get("limit", ["20"])[0])
+            offset = int(query.get("offset", ["0"])[0])
+            results = [
+                {"name": n, "url": f"/api/v2/pokemon/{self.index[n]}/"}
+                for n in self.names[offset:offset + limit]
+            ]
+            return self.send_json(200, {"count": len(self.names), "results": results})
+
+        if path.startswith("/api/v2/pokemon/"):
+            key = path.rsplit("/", 1)[1].lower()
+            if key.isdigit() and 0 < int(key) <= len(self.names):
+                key = self.names[int(key) - 1]
+            if key not in self.index:
+                return self.send_json(404, {"detail": "Not found."})
+            payload = self.payload_cache.get(key)
+            if payload is None:
+                payload = self.payload_cache[key] = build_pokemon(key, self.index[key])
+            return self.send_json(200, payload)
+
+        self.send_json(404, {"detail": "Not found."})
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0) -> ThreadingHTTPServer:
+    """Inicia el servidor en un hilo daemon y lo devuelve (port=0 elige un puerto libre)"""
+    handler = type("Handler", (FakePokeAPIHandler,), {"latency": latency})
+    server = QuietServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="PokeAPI local para benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="Latencia artificial por request (segundos)")
+    args = parser.parse_args()
+
+    srv = start_server(args.host, args.port, args.latency)
+    print(f"PokeAPI local en http://{args.host}:{srv.server_port}/api/v2")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        srv.shutdown()
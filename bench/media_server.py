@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Servidor local de archivos multimedia para benchmarks.
+
+Cualquier ruta /media/<nombre>.<ext> devuelve contenido determinista del tamaño
+indicado con ?size=<bytes> (por defecto 2 MB). El Content-Type de video/audio
+hace que el extractor genérico de yt-dlp lo trate como descarga directa.
+Soporta HEAD y peticiones Range para que yt-dlp pueda reanudar.
+"""
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_SIZE = 2 * 1024 * 1024
+CONTENT_TYPES = {
+    "mp4": "video/mp4",
+    "webm": "video/webm",
+    "m4a": "audio/mp4",
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg",
+}
+# Bloque base que se repite para generar el contenido sin guardarlo en memoria
+CHUNK = bytes(range(256)) * 256
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Los clientes cierran conexiones a mitad de respuesta con frecuencia; no es un error
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    throttle_bps = 0  # Límite de ancho de banda por conexión (0 = sin límite)
+
+    def log_message(self, format, *args):
+        pass
+
+    def resolve(self):
+        parsed = urlparse(self.path)
+        match = re.fullmatch(r"/media/[\w.-]+\.(\w+)", parsed.path)
+        if not match or match.group(1) not in CONTENT_TYPES:
+            return None, None
+        size = int(parse_qs(parsed.query).get("size", [DEFAULT_SIZE])[0])
+        return CONTENT_TYPES[match.group(1)], size
+
+    def send_headers(self, content_type: str, size: int):
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header or "")
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        return start, end
+
+    def do_HEAD(self):
+        content_type, size = self.resolve()
+        if content_type is None:
+            self.send_error(404)
+            return
+        self.send_headers(content_type, size)
+
+    def do_GET(self):
+        content_type, size = self.resolve()
+        if content_type is None:
+            self.send_error(404)
+            return
+        byte_range = self.send_headers(content_type, size)
+        if byte_range is None:
+            return
+        position, end = byte_range
+        while position <= end:
+            offset = position % len(CHUNK)
+            piece = CHUNK[offset:offset + min(len(CHUNK) - offset, end - position + 1)]
+            try:
+                self.wfile.write(piece)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            position += len(piece)
+            if self.throttle_bps:
+                threading.Event().wait(len(piece) / self.throttle_bps)
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, throttle_bps: int = 0) -> ThreadingHTTPServer:
+    """Inicia el servidor en un hilo daemon y lo devuelve (port=0 elige un puerto libre)"""
+    handler = type("Handler", (MediaHandler,), {"throttle_bps": throttle_bps})
+    server = QuietServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Servidor local de medios para benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--throttle", type=int, default=0, help="Bytes por segundo por conexión (0 = sin límite)")
+    args = parser.parse_args()
+
+    srv = start_server(args.host, args.port, args.throttle)
+    print(f"Medios locales en http://{args.host}:{srv.server_port}/media/<nombre>.mp4?size=<bytes>")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        srv.shutdown()
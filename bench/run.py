@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark y prueba de carga de Lab 06 sin acceso a internet.
+
+Levanta una PokeAPI local (fake_pokeapi.py), un servidor de medios local
+(media_server.py) y, salvo que se indique --base-url, la aplicación Flask en
+el mismo proceso. Luego mide throughput y latencias p50/p95/p99 por endpoint
+con distintos niveles de concurrencia.
+
+Uso:
+    python bench/run.py
+    python bench/run.py --concurrency 1,8,32 --requests 200 --json bench_output.json
+    python bench/run.py --scenarios pokemon,downloads_list --base-url http://127.0.0.1:5001
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fake_pokeapi  # noqa: E402
+import media_server  # noqa: E402
+
+SCENARIOS = ["pokemon", "formats", "download", "downloads_list"]
+TERMINAL_STATUSES = {"completed", "error", "cancelled"}
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def start_app(pokeapi_url: str) -> str:
+    """Importa app.py apuntando a la PokeAPI local y la sirve en un hilo; devuelve la URL base"""
+    os.environ["POKEAPI_BASE_URL"] = pokeapi_url
+    os.environ.setdefault("DOWNLOAD_DIR", tempfile.mkdtemp(prefix="lab06-bench-"))
+    from werkzeug.serving import make_server
+    import app as lab_app
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    server = make_server("127.0.0.1", 0, lab_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+class Scenarios:
+    """Cada escenario hace una operación completa y lanza excepción si falla"""
+
+    def __init__(self, base_url: str, media_url: str, args):
+        self.base_url = base_url
+        self.media_url = media_url
+        self.args = args
+        self.names = fake_pokeapi.BASE_NAMES
+        self.counter = itertools.count()
+        self.local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        # Una sesión por hilo para reutilizar conexiones
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def media(self, name: str) -> str:
+        return f"{self.media_url}/media/{name}.mp4?size={self.args.media_size}"
+
+    def pokemon(self):
+        if random.random() < self.args.miss_ratio:
+            # Nombre mal escrito: ejercita find_similar_pokemon
+            name = random.choice(self.names)[:-1] + "x"
+        else:
+            name = random.choice(self.names)
+        r = self.session.post(f"{self.base_url}/pokemon", data={"name": name}, timeout=60)
+        r.raise_for_status()
+
+    def formats(self):
+        url = self.media(f"clip-{next(self.counter) % 50}")
+        r = self.session.post(f"{self.base_url}/api/formats/list", json={"url": url}, timeout=60)
+        r.raise_for_status()
+
+    def download(self):
+        # Nombre único por tarea para que los archivos descargados no colisionen
+        url = self.media(f"bench-{os.getpid()}-{next(self.counter)}")
+        r = self.session.post(f"{self.base_url}/api/download/start", json={"url": url, "quality": "best"}, timeout=60)
+        r.raise_for_status()
+        task_id = r.json()["task_id"]
+        deadline = time.monotonic() + self.args.download_timeout
+        while time.monotonic() < deadline:
+            p = self.session.get(f"{self.base_url}/api/download/progress/{task_id}", timeout=60)
+            p.raise_for_status()
+            progress = p.json()
+            if progress.get("status") in TERMINAL_STATUSES:
+                if progress["status"] == "error":
+                    raise RuntimeError(progress.get("message"))
+                return
+            time.sleep(self.args.poll_interval)
+        raise TimeoutError(f"La tarea {task_id} no terminó a tiempo")
+
+    def downloads_list(self):
+        r = self.session.get(f"{self.base_url}/api/downloads/list", timeout=60)
+        r.raise_for_status()
+
+
+def run_level(fn, concurrency: int, total: int) -> dict:
+    """Ejecuta `total` operaciones con `concurrency` hilos y resume las latencias"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            fn()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - wall_start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "ok": len(latencies),
+        "errors": len(errors),
+        "sample_error": errors[0] if errors else None,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de Lab 06 con servicios locales")
+    parser.add_argument("--base-url", help="URL de una instancia ya levantada (por defecto se levanta en proceso)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Lista separada por comas: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="Niveles de concurrencia separados por comas")
+    parser.add_argument("--requests", type=int, default=50, help="Operaciones por escenario y nivel")
+    parser.add_argument("--warmup", type=int, default=3, help="Operaciones de calentamiento por escenario")
+    parser.add_argument("--miss-ratio", type=float, default=0.1, help="Fracción de búsquedas de Pokémon inexistentes")
+    parser.add_argument("--media-size", type=int, default=media_server.DEFAULT_SIZE, help="Tamaño de cada archivo de prueba en bytes")
+    parser.add_argument("--media-throttle", type=int, default=0, help="Bytes por segundo por conexión del servidor de medios")
+    parser.add_argument("--pokeapi-latency", type=float, default=0.0, help="Latencia artificial de la PokeAPI local (segundos)")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="Intervalo de consulta de progreso (segundos)")
+    parser.add_argument("--download-timeout", type=float, default=120.0, help="Tiempo máximo por descarga (segundos)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", help="Guardar resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Escenarios desconocidos: {', '.join(sorted(unknown))}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    pokeapi = fake_pokeapi.start_server(latency=args.pokeapi_latency)
+    media = media_server.start_server(throttle_bps=args.media_throttle)
+    pokeapi_url = f"http://127.0.0.1:{pokeapi.server_port}/api/v2"
+    media_url = f"http://127.0.0.1:{media.server_port}"
+
+    if args.base_url:
+        base_url = args.base_url.rstrip("/")
+        print(f"Usando instancia externa {base_url} (debe apuntar POKEAPI_BASE_URL a {pokeapi_url})")
+    else:
+        base_url = start_app(pokeapi_url)
+        print(f"Aplicación en proceso: {base_url}")
+
+    runner = Scenarios(base_url, media_url, args)
+    results = []
+    header = f"{'escenario':<16}{'conc':>6}{'ok':>6}{'err':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for name in scenarios:
+        fn = getattr(runner, name)
+        for _ in range(args.warmup):
+            try:
+                fn()
+            except Exception:
+                pass
+        for level in levels:
+            summary = {"scenario": name, **run_level(fn, level, args.requests)}
+            results.append(summary)
+            print(f"{name:<16}{level:>6}{summary['ok']:>6}{summary['errors']:>6}{summary['throughput_rps']:>10}"
+                  f"{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['p99_ms']:>10}")
+            if summary["sample_error"]:
+                print(f"  ejemplo de error: {summary['sample_error'][:160]}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
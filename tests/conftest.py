@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Configuración común: app.py crea directorios al importarse, así que se apuntan a temporales"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_tmp = tempfile.mkdtemp(prefix="lab06-tests-")
+for var in ("DOWNLOAD_DIR", "SPRITE_CACHE_DIR", "PREVIEW_CACHE_DIR"):
+    os.environ.setdefault(var, os.path.join(_tmp, var.lower()))
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
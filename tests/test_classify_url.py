@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Clasificación de URLs: plataforma por etiquetas completas y URL canónica"""
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("url,platform", [
+    ("https://x.com/nasa/status/1", "twitter"),
+    ("https://mobile.twitter.com/nasa/status/1", "twitter"),
+    ("https://m.youtube.com/watch?v=dQw4w9WgXcQ", "youtube"),
+    ("https://vm.tiktok.com/ZMabc123/", "tiktok"),
+    ("https://box.com/s/abc", None),
+    ("https://fx.com/video", None),
+    ("https://notyoutube.com/watch?v=dQw4w9WgXcQ", None),
+    ("https://youtube.com.evil.example/watch?v=dQw4w9WgXcQ", None),
+])
+def test_platform_matches_whole_labels(url, platform):
+    assert app.classify_url(url).platform == platform
+
+
+@pytest.mark.parametrize("url", [
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&feature=share&utm_source=x",
+    "https://youtube.com/shorts/dQw4w9WgXcQ",
+    "https://www.youtube.com/embed/dQw4w9WgXcQ",
+    "youtube.com/watch?v=dQw4w9WgXcQ",
+])
+def test_youtube_variants_share_canonical_url(url):
+    assert app.canonical_url(url) == "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+
+def test_twitter_and_x_share_canonical_url():
+    assert app.canonical_url("https://twitter.com/nasa/status/123?s=20") == "https://x.com/nasa/status/123"
+    assert app.canonical_url("https://x.com/nasa/status/123") == "https://x.com/nasa/status/123"
+
+
+def test_instagram_drops_user_and_igsh():
+    url = "https://www.instagram.com/someone/reels/Cabc_123/?igsh=xyz"
+    assert app.canonical_url(url) == "https://www.instagram.com/reel/Cabc_123/"
+
+
+def test_invalid_youtube_id_is_not_canonicalized():
+    result = app.classify_url("https://www.youtube.com/watch?v=dQw4")
+    assert result.platform == "youtube"
+    assert result.canonical == "https://www.youtube.com/watch?v=dQw4"
+
+
+def test_generic_url_only_loses_tracking_params():
+    assert app.canonical_url("https://example.com/v.mp4?utm_source=a&fbclid=b&t=10") == "https://example.com/v.mp4?t=10"
+    assert app.canonical_url("https://example.com/v.mp4?t=10") == "https://example.com/v.mp4?t=10"
+
+
+@pytest.mark.parametrize("url", ["", "   ", "not a url", "https://"])
+def test_unparseable_urls_have_no_platform(url):
+    assert app.classify_url(url).platform is None
+
+
+@pytest.mark.parametrize("url", ["http://[abc/video", "https://[::1/x"])
+def test_malformed_urls_keep_the_original_url(url):
+    assert app.classify_url(url) == (None, url)
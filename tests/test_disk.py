@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Publicación de descargas y espacio reservado"""
+import os
+from collections import namedtuple
+
+import app
+
+DiskUsage = namedtuple("DiskUsage", ["total", "used", "free"])
+
+
+def scratch_file(task_id, name, data):
+    task_dir = app.task_scratch_dir(task_id)
+    os.makedirs(task_dir, exist_ok=True)
+    path = os.path.join(task_dir, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def test_publish_never_overwrites_same_name():
+    names = [app.publish_download(scratch_file(f"pub-{i}", "Mismo_titulo.mp4", bytes([i]) * 10)) for i in range(3)]
+    assert names == ["Mismo_titulo.mp4", "Mismo_titulo_1.mp4", "Mismo_titulo_2.mp4"]
+    for i, name in enumerate(names):
+        with open(os.path.join(app.DOWNLOAD_DIR, name), "rb") as f:
+            assert f.read() == bytes([i]) * 10
+    assert not os.listdir(app.task_scratch_dir("pub-0"))
+
+
+def test_reservation_shrinks_as_the_task_writes(monkeypatch):
+    monkeypatch.setattr(app, "disk_reservations", {"t1": {app.DOWNLOAD_DIR: 1000}})
+    state = app.TaskState()
+    monkeypatch.setitem(app.download_progress, "t1", state)
+    monkeypatch.setattr(app, "SCRATCH_SAME_VOLUME", True)
+    monkeypatch.setattr(app.shutil, "disk_usage", lambda directory: DiskUsage(10 ** 12, 0, 10 ** 12))
+    before = app.disk_available(app.DOWNLOAD_DIR)
+    state.downloaded_bytes = 400
+    assert app.disk_available(app.DOWNLOAD_DIR) - before == 400
+    state.downloaded_bytes = 5000  # Más de lo estimado: la reserva no se vuelve negativa
+    assert app.disk_available(app.DOWNLOAD_DIR) - before == 1000
+
+
+def test_publish_without_hard_links(monkeypatch):
+    def no_link(src, dst):
+        raise OSError(app.errno.EPERM, "Operation not permitted")
+
+    monkeypatch.setattr(app.os, "link", no_link)
+    names = [app.publish_download(scratch_file(f"nolink-{i}", "Sin_enlaces.mp4", bytes([i]) * 10)) for i in range(2)]
+    assert names == ["Sin_enlaces.mp4", "Sin_enlaces_1.mp4"]
+    for i, name in enumerate(names):
+        with open(os.path.join(app.DOWNLOAD_DIR, name), "rb") as f:
+            assert f.read() == bytes([i]) * 10
+
+
+def test_cleanup_removes_stale_publish_copies():
+    stale = os.path.join(app.DOWNLOAD_DIR, f".video.mp4.{'a' * 32}.tmp")
+    fresh = os.path.join(app.DOWNLOAD_DIR, f".video.mp4.{'b' * 32}.tmp")
+    for path in (stale, fresh):
+        with open(path, "wb") as f:
+            f.write(b"x")
+    old = os.path.getmtime(stale) - app.PARTIAL_GRACE_SECONDS - 10
+    os.utime(stale, (old, old))
+    app.collect_orphan_partials()
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
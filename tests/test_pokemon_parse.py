@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""El parseo parcial debe dar exactamente lo mismo que el parseo completo"""
+import json
+
+import pytest
+
+import app
+from fake_pokeapi import build_pokemon
+
+
+def full_parse(text, name):
+    return app.project_pokemon(json.loads(text), name)
+
+
+@pytest.mark.parametrize("name,index", [("pikachu", 25), ("charizard", 6), ("mew", 151)])
+def test_partial_parse_matches_full_parse(name, index):
+    text = json.dumps(build_pokemon(name, index))
+    assert app.parse_pokemon_payload(text, name) == full_parse(text, name)
+
+
+def test_partial_parse_without_moves():
+    text = json.dumps(build_pokemon("ditto", 132, moves=0))
+    assert app.parse_pokemon_payload(text, "ditto") == full_parse(text, "ditto")
+
+
+def test_numeric_name_uses_real_name():
+    text = json.dumps(build_pokemon("pikachu", 25))
+    result = app.parse_pokemon_payload(text, "25")
+    assert result == full_parse(text, "25")
+    assert result["name"] == "pikachu"
+
+
+def test_past_types_falls_back_to_full_parse():
+    data = build_pokemon("clefairy", 35)
+    data["past_types"] = [{"generation": {"name": "generation-v", "url": ""},
+                           "types": [{"slot": 1, "type": {"name": "normal", "url": ""}}]}]
+    text = json.dumps(data)
+    result = app.parse_pokemon_payload(text, "clefairy")
+    assert result == full_parse(text, "clefairy")
+    assert result["types"] == [t["type"]["name"] for t in data["types"]]
+
+
+def test_compact_and_indented_json():
+    data = build_pokemon("gengar", 94)
+    for text in (json.dumps(data, separators=(",", ":")), json.dumps(data, indent=2)):
+        assert app.parse_pokemon_payload(text, "gengar") == full_parse(text, "gengar")
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Sondeo anticipado de formatos: qué URLs se sondean y cuántos sondeos se lanzan"""
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.you",
+    "https://www.youtube.com/",
+    "https://www.youtube.com/watch?v=dQw",
+    "https://www.youtube.com/watch?v=dQw4w9Wg",
+    "https://x.com/nasa",
+    "https://x.com/nasa/status/",
+    "https://www.instagram.com/p/",
+    "https://www.tiktok.com/@user",
+    "https://www.facebook.com/",
+    "https://example.com/",
+    "https://localhost",
+    "https://exam",
+])
+def test_incomplete_urls_are_not_prefetched(url):
+    assert app.prefetch_url_error(url) is not None
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "https://x.com/nasa/status/123",
+    "https://www.instagram.com/reel/Cabc_123/",
+    "https://www.tiktok.com/@user/video/123",
+    "https://vm.tiktok.com/ZMabc123/",
+    "https://www.facebook.com/watch?v=123",
+    "https://www.facebook.com/page/videos/123/",
+    "https://fb.watch/abcDEF/",
+    "https://example.com/video.mp4",
+])
+def test_complete_urls_are_prefetched(url):
+    assert app.prefetch_url_error(url) is None
+
+
+@pytest.fixture
+def blocked_probes(monkeypatch):
+    """build_formats_response que no termina hasta que la prueba lo libera"""
+    release = threading.Event()
+
+    def fake_build(url):
+        release.wait(5)
+        return {"formats": []}, 200
+
+    monkeypatch.setattr(app, "build_formats_response", fake_build)
+    monkeypatch.setattr(app, "formats_probes", app.OrderedDict())
+    monkeypatch.setattr(app, "session_probes", app.OrderedDict())
+    yield release
+    release.set()
+
+
+def test_no_prefetch_when_pool_is_full(blocked_probes):
+    probes = [app.start_formats_probe(f"https://example.com/v{i}.mp4", f"s{i}")[0]
+              for i in range(app.FORMATS_PROBE_WORKERS)]
+    assert all(probe is not None for probe in probes)
+    assert app.start_formats_probe("https://example.com/extra.mp4", "other") == (None, False)
+    # Un sondeo existente se sigue reutilizando
+    assert app.start_formats_probe("https://example.com/v0.mp4", "s0")[0] is probes[0]
+    blocked_probes.set()
+    for probe in probes:
+        probe.future.result(5)
+    assert app.start_formats_probe("https://example.com/extra.mp4", "other")[0] is not None
+
+
+def test_evicted_speculative_probe_is_cancelled(blocked_probes, monkeypatch):
+    monkeypatch.setattr(app, "FORMATS_PROBE_CACHE_SIZE", 1)
+    # Un worker ocupado con el primer sondeo deja al resto esperando en la cola
+    monkeypatch.setattr(app, "formats_probe_pool", app.ThreadPoolExecutor(max_workers=1))
+    running, _ = app.start_formats_probe("https://example.com/a.mp4", "s1")
+    queued, _ = app.start_formats_probe("https://example.com/b.mp4", "s2")
+    app.start_formats_probe("https://example.com/c.mp4", "s3")
+    assert queued.future.cancelled()
+    assert not running.future.cancelled()
+    assert list(app.formats_probes) == [app.canonical_url("https://example.com/c.mp4")]
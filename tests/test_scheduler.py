@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Orden del planificador: reparto justo entre clientes y tarea más corta primero"""
+import pytest
+
+import app
+
+MB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def plenty_of_disk(monkeypatch):
+    monkeypatch.setattr(app, "disk_available", lambda directory: float("inf"))
+    yield
+    app.disk_reservations.clear()
+
+
+def make_scheduler(workers):
+    scheduler = app.DownloadScheduler(workers)
+    scheduler.started = True  # Sin hilos: las pruebas llaman a _next_job directamente
+    return scheduler
+
+
+def submit(scheduler, task_id, client, cost):
+    scheduler.submit(app.QueuedDownload(task_id, client, cost, ()))
+
+
+def drain(scheduler):
+    """Orden en que saldrían las tareas si cada una terminara antes de elegir la siguiente"""
+    order = []
+    with scheduler.cond:
+        while True:
+            job = scheduler._next_job()
+            if job is None:
+                return order
+            order.append(job.task_id)
+            scheduler.running -= 1
+            if not job.small:
+                scheduler.running_large -= 1
+
+
+def test_shortest_job_first_within_a_client():
+    scheduler = make_scheduler(1)
+    submit(scheduler, "big", "a", 400 * MB)
+    submit(scheduler, "small", "a", 10 * MB)
+    submit(scheduler, "medium", "a", 100 * MB)
+    assert drain(scheduler) == ["small", "medium", "big"]
+
+
+def test_fair_share_between_clients():
+    scheduler = make_scheduler(1)
+    for i in range(3):
+        submit(scheduler, f"a{i}", "a", 100 * MB)
+    submit(scheduler, "b0", "b", 100 * MB)
+    # El segundo cliente no espera a que termine todo el lote del primero
+    assert drain(scheduler) == ["a0", "b0", "a1", "a2"]
+
+
+def test_fair_share_counts_bytes_not_jobs():
+    scheduler = make_scheduler(1)
+    submit(scheduler, "a-big", "a", 800 * MB)
+    for i in range(4):
+        submit(scheduler, f"b{i}", "b", 100 * MB)
+    # Tras una tarea de 800 MB del cliente a, el cliente b recupera ese servicio
+    assert drain(scheduler) == ["a-big", "b0", "b1", "b2", "b3"]
+
+
+def test_weights_favour_heavier_client(monkeypatch):
+    monkeypatch.setitem(app.CLIENT_WEIGHTS, "gold", 3.0)
+    scheduler = make_scheduler(1)
+    for i in range(4):
+        submit(scheduler, f"g{i}", "key:gold", 100 * MB)
+        submit(scheduler, f"p{i}", "1.2.3.4", 100 * MB)
+    # Con peso 3, cada tarea de gold cuenta un tercio
+    assert drain(scheduler) == ["g0", "p0", "g1", "g2", "g3", "p1", "p2", "p3"]
+
+
+def test_worker_reserved_for_small_jobs():
+    scheduler = make_scheduler(2)
+    submit(scheduler, "big1", "a", 400 * MB)
+    submit(scheduler, "big2", "b", 400 * MB)
+    with scheduler.cond:
+        first = scheduler._next_job()
+        assert first.task_id in ("big1", "big2")
+        # El único worker libre queda para tareas pequeñas
+        assert scheduler._next_job() is None
+    submit(scheduler, "mp3", "c", 5 * MB)
+    with scheduler.cond:
+        assert scheduler._next_job().task_id == "mp3"
+
+
+def test_aging_lets_a_waiting_large_job_through():
+    scheduler = make_scheduler(1)
+    submit(scheduler, "old-big", "a", 200 * MB)
+    scheduler.queues["a"][0].enqueued -= 10 * app.AGING_HALF_LIFE
+    submit(scheduler, "new-small", "a", 10 * MB)
+    assert drain(scheduler) == ["old-big", "new-small"]
+
+
+def test_removed_job_is_not_scheduled():
+    scheduler = make_scheduler(1)
+    submit(scheduler, "keep", "a", 10 * MB)
+    submit(scheduler, "drop", "a", 5 * MB)
+    assert scheduler.remove("drop")
+    assert not scheduler.remove("drop")
+    assert drain(scheduler) == ["keep"]